@@ -0,0 +1,228 @@
+"""Замеры скорости и памяти отрисовки глав на сгенерированных данных.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.render
+    python -m benchmarks.render --paragraphs 2000 --depth 4 --save benchmarks/baseline.json
+    python -m benchmarks.render --baseline benchmarks/baseline.json
+
+С `--baseline` программа завершается с кодом 1, если какой-то замер медленнее базового или расходует больше памяти
+(пик по tracemalloc) больше, чем на `--tolerance`.
+Базовые значения зависят от машины, поэтому их нужно снимать на той же машине, где потом сравнивать.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable
+
+from src.epub import render_chapter as render_epub
+from src.fb2 import FB2Handler, MyFictionBook2, render_chapter as render_fb2
+from src.model import ChapterData, RenderTask
+from src.utils import is_html
+
+MARKS = ("bold", "italic", "underline", "strike")
+
+
+def _text(rng: random.Random, words: int) -> dict:
+    node: dict = {
+        "type": "text",
+        "text": " ".join(rng.choice(("слово", "ранобэ", "глава", "текст")) for _ in range(words)),
+    }
+    marks = rng.sample(MARKS, rng.randint(0, len(MARKS)))
+    if marks:
+        node["marks"] = [{"type": mark} for mark in marks]
+    return node
+
+
+def _paragraph(rng: random.Random) -> dict:
+    return {
+        "type": "paragraph",
+        "attrs": {"textAlign": rng.choice((None, None, None, "center", "right"))},
+        "content": [_text(rng, rng.randint(3, 15)) for _ in range(rng.randint(1, 4))],
+    }
+
+
+def _block(rng: random.Random, depth: int, images: list[str]) -> dict:
+    kind = rng.random()
+    if depth > 0 and kind < 0.05:
+        return {"type": "blockquote", "content": [_block(rng, depth - 1, images) for _ in range(rng.randint(1, 3))]}
+    if depth > 0 and kind < 0.1:
+        return {
+            "type": rng.choice(("bulletList", "orderedList")),
+            "content": [
+                {"type": "listItem", "content": [_block(rng, depth - 1, images)]} for _ in range(rng.randint(1, 4))
+            ],
+        }
+    if kind < 0.12:
+        return {"type": "horizontalRule"}
+    if kind < 0.15:
+        return {"type": "heading", "attrs": {"level": rng.randint(2, 4)}, "content": [_text(rng, 4)]}
+    if kind < 0.17:
+        name = f"img{len(images)}"
+        images.append(name)
+        return {"type": "image", "attrs": {"images": [{"image": name}]}}
+    return _paragraph(rng)
+
+
+def make_doc_chapter(paragraphs: int, depth: int, seed: int = 0) -> ChapterData:
+    """Глава в формате doc (ProseMirror) с разметкой, списками, цитатами и картинками."""
+    rng = random.Random(seed)
+    images: list[str] = []
+    content = [_block(rng, depth, images) for _ in range(paragraphs)]
+    attachments = [
+        {"id": str(i), "filename": f"{name}.png", "name": name, "extension": "png", "url": f"/{name}.png"}
+        for i, name in enumerate(images)
+    ]
+    data = {"id": seed, "content": {"type": "doc", "content": content}, "attachments": attachments}
+    return ChapterData(number="1", volume="1", raw=json.dumps({"data": data}).encode())
+
+
+def make_html_chapter(paragraphs: int, seed: int = 0) -> ChapterData:
+    """Глава в формате html с абзацами, выделением и картинками."""
+    rng = random.Random(seed)
+    parts = []
+    for i in range(paragraphs):
+        text = _text(rng, rng.randint(5, 30))["text"]
+        if i % 25 == 24:
+            parts.append(f'<img src="https://ranobelib.me/img/{i}.png">')
+        elif i % 7 == 0:
+            parts.append(f"<p><strong>{text}</strong> <em>{text}</em></p>")
+        else:
+            parts.append(f"<p>{text}</p>")
+    data = {"id": seed, "content": "".join(parts), "attachments": []}
+    return ChapterData(number="1", volume="1", raw=json.dumps({"data": data}).encode())
+
+
+def _fresh(chapter: ChapterData) -> ChapterData:
+    # Новая глава на каждый прогон: разобранное тело кешируется в самой главе.
+    return ChapterData(number=chapter.number, volume=chapter.volume, raw=chapter.raw)
+
+
+def _task(chapter: ChapterData) -> RenderTask:
+    # JSON разбирается здесь, до замера: иначе отрисовка мерила бы в основном разбор. Он меряется отдельно (decode_*).
+    chapter = _fresh(chapter)
+    images = {key: f"static/{filename}" for key, _, filename, _ in chapter.image_sources}
+    chapter.content
+    return RenderTask(chapter=chapter, title="Том 1. Глава 1. Глава", images=images, with_images=True)
+
+
+def _fb2_book(sections: int, paragraphs: int, depth: int) -> MyFictionBook2:
+    handler = FB2Handler(log_func=lambda text: None, progress_bar_step=lambda step: None)
+    handler.cover = b""
+    handler.make_book({"name": "Benchmark", "summary": "", "authors": [], "genres": [], "cover": {"default": ""}})
+    for i in range(sections):
+        volume = str(i // 10 + 1)
+        handler.book.sections.append((volume, render_fb2(_task(make_doc_chapter(paragraphs, depth, seed=i)))))
+    handler.book.titleInfo.coverPageImages = None
+    return handler.book
+
+
+def _write_fb2(book: MyFictionBook2) -> None:
+    with open(os.devnull, "wb") as f:
+        book.write_to(f)
+
+
+# Замер: подготовка (не входит ни во время, ни в память) и сам замеряемый вызов.
+Case = tuple[Callable[[], Any], Callable[[Any], object]]
+
+
+def cases(paragraphs: int, depth: int, sections: int) -> dict[str, Case]:
+    doc = make_doc_chapter(paragraphs, depth)
+    html = make_html_chapter(paragraphs)
+    html_text = _fresh(html).content
+    book = _fb2_book(sections, paragraphs // 10 or 1, depth)
+    return {
+        "decode_doc": (lambda: _fresh(doc), lambda chapter: chapter.content),
+        "decode_html": (lambda: _fresh(html), lambda chapter: chapter.content),
+        "epub_doc": (lambda: _task(doc), render_epub),
+        "epub_html": (lambda: _task(html), render_epub),
+        "fb2_doc": (lambda: _task(doc), render_fb2),
+        "fb2_html": (lambda: _task(html), render_fb2),
+        "is_html": (lambda: html_text, is_html),
+        "fb2_book": (lambda: book, _write_fb2),
+    }
+
+
+def measure(case: Case, repeat: int) -> dict[str, float]:
+    prepare, func = case
+    func(prepare())
+    times = []
+    for _ in range(repeat):
+        arg = prepare()
+        start = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - start)
+
+    # Память меряем отдельным прогоном: tracemalloc заметно замедляет код и исказил бы время.
+    arg = prepare()
+    tracemalloc.start()
+    func(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"time_ms": statistics.median(times) * 1000, "peak_kb": peak / 1024}
+
+
+def compare(results: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]], tolerance: float) -> bool:
+    ok = True
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        time_ratio = result["time_ms"] / base["time_ms"]
+        memory_ratio = result["peak_kb"] / base["peak_kb"] if base["peak_kb"] else 1.0
+        status = []
+        if time_ratio > 1 + tolerance:
+            status.append("МЕДЛЕННЕЕ")
+        if memory_ratio > 1 + tolerance:
+            status.append("БОЛЬШЕ ПАМЯТИ")
+        ok = ok and not status
+        print(
+            f"{name:<12} {base['time_ms']:>10.2f} -> {result['time_ms']:>10.2f} мс  x{time_ratio:.2f}"
+            f"  {base['peak_kb']:>10.1f} -> {result['peak_kb']:>10.1f} КБ  x{memory_ratio:.2f}"
+            f"  {', '.join(status) or 'ok'}"
+        )
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--paragraphs", type=int, default=500, help="блоков верхнего уровня в главе")
+    parser.add_argument("--depth", type=int, default=3, help="глубина вложенности списков и цитат")
+    parser.add_argument("--sections", type=int, default=50, help="глав в книге для замера сборки FB2")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", nargs="*", help="запустить только указанные замеры")
+    parser.add_argument("--save", help="сохранить результаты в JSON как базовые")
+    parser.add_argument("--baseline", help="сравнить с базовыми результатами из JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое замедление и рост памяти, доля")
+    args = parser.parse_args()
+
+    results: dict[str, dict[str, float]] = {}
+    for name, case in cases(args.paragraphs, args.depth, args.sections).items():
+        if args.only and name not in args.only:
+            continue
+        results[name] = measure(case, args.repeat)
+        print(f"{name:<12} {results[name]['time_ms']:>10.2f} мс {results[name]['peak_kb']:>12.1f} КБ")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args) | {"save": None, "baseline": None}, "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("args", {}).get("paragraphs") != args.paragraphs:
+            print("Внимание: базовые результаты сняты на главах другого размера.")
+        print()
+        if not compare(results, baseline["results"], args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
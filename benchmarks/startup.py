@@ -0,0 +1,57 @@
+"""Замер времени импорта при запуске программы.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --repeat 20 --modules src.menu src.epub
+
+Каждый импорт выполняется в новом процессе, чтобы не мешали уже загруженные модули.
+Из результата вычитается время запуска пустого интерпретатора.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+TARGETS = {
+    "интерфейс": "src.menu",
+    "без интерфейса": "src.handler",
+    "epub": "src.epub",
+    "fb2": "src.fb2",
+}
+
+
+def measure(statement: str, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def heavy_modules(module: str) -> list[str]:
+    """Какие из тяжёлых зависимостей оказываются загружены после импорта модуля."""
+    heavy = ("PIL", "cloudscraper", "bs4", "ebooklib", "FB2", "textual", "textual_fspicker", "cryptography")
+    code = f"import sys, {module}; print(' '.join(m for m in {heavy!r} if m in sys.modules))"
+    return subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout.split()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--modules", nargs="*", help="замерить указанные модули вместо стандартного набора")
+    args = parser.parse_args()
+
+    targets = {module: module for module in args.modules} if args.modules else TARGETS
+    empty = measure("pass", args.repeat)
+    print(f"{'пустой интерпретатор':<22} {empty:>8.1f} мс")
+    for name, module in targets.items():
+        elapsed = measure(f"import {module}", args.repeat) - empty
+        print(f"{name:<22} {elapsed:>8.1f} мс  {' '.join(heavy_modules(module))}")
+
+
+if __name__ == "__main__":
+    main()
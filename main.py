@@ -1,11 +1,11 @@
 import logging
+import multiprocessing
 from pathlib import Path
 from typing import Dict
 
-from src.model import Handler
-from src.menu import Ranobe2ebook
-from src.fb2 import FB2Handler
-from src.epub import EpubHandler
+from src.config import config
+from src.handler import HANDLERS
+from src.profile import ProfileError, load_profile
 
 
 def setup_logging(logs_dir: Path) -> None:
@@ -18,19 +18,29 @@ def setup_logging(logs_dir: Path) -> None:
     )
 
 
-def get_handlers() -> Dict[str, Handler]:
-    """Возвращает словарь доступных обработчиков форматов."""
-    return {"fb2": FB2Handler, "epub": EpubHandler}
+def get_handlers() -> Dict[str, str]:
+    """Возвращает словарь доступных обработчиков форматов: имя -> "модуль:класс", см. `src.handler.load_handler`."""
+    return dict(HANDLERS)
 
 
 def main() -> None:
-    docs_path = Path.home() / "Documents"
-    logs_dir = docs_path / "ranobelib-parser-logs"
+    try:
+        load_profile()
+    except ProfileError as e:
+        print(e)
+        input("Нажмите Enter для выхода...")
+        return
+
+    logs_dir = Path(config.logs_dir) if config.logs_dir else Path.home() / "Documents" / "ranobelib-parser-logs"
 
     setup_logging(logs_dir)
     logger = logging.getLogger(__name__)
 
     try:
+        # Импорт здесь, а не в начале файла: процессы отрисовки глав импортируют этот модуль заново,
+        # и интерфейс им не нужен.
+        from src.menu import Ranobe2ebook
+
         app = Ranobe2ebook(handlers=get_handlers())
         app.run()
     except Exception as e:
@@ -40,4 +50,5 @@ def main() -> None:
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
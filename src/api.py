@@ -1,43 +1,165 @@
-import io
+import os
+import random
+import threading
 import time
+from functools import cache
+from typing import Callable
 from urllib.parse import urlparse
 
-from PIL import Image
-import PIL
-import cloudscraper
 import requests
 
 from src.config import config
-from src.model import Attachment, ChapterData, ChapterMeta
-from src.utils import is_html, is_url
+from src.hedge import Hedger
+from src.imagestore import ImageSkipped, image_store
+from src.model import ChapterData, ChapterMeta, StoredFile
+from src.session import get_scraper
+from src.singleflight import SingleFlight
+from src.utils import is_url, json_loads
 
 
 def get_base_api_url() -> str | None:
+    """Адрес API. Можно задать явно (`config.api_url` или переменная окружения RANOBE2EBOOK_API_URL),
+    например чтобы работать с локальной заглушкой API, иначе он берётся из гиста."""
+    api_url = config.api_url or os.environ.get("RANOBE2EBOOK_API_URL", "")
+    if api_url:
+        return api_url.rstrip("/")
+    return _fetch_base_api_url()
+
+
+@cache
+def _fetch_base_api_url() -> str | None:
     response = requests.get(
-        f"https://gist.githubusercontent.com/DustGalaxy/958d8a9fe76d7253d1511d99d180d1c5.txt?nocache={int(time.time())}"
+        f"https://gist.githubusercontent.com/DustGalaxy/958d8a9fe76d7253d1511d99d180d1c5.txt?nocache={int(time.time())}",
+        timeout=(config.connect_timeout, config.read_timeout),
     )
     if response.status_code == 200:
         return str(response.content.decode("utf-8")).strip()
 
 
-BASE_API_URL = get_base_api_url()
-HOST = urlparse(BASE_API_URL).hostname
+def get_api_host() -> str | None:
+    return urlparse(get_base_api_url()).hostname
+
+
+TRANSIENT_STATUSES = {408, 425, 429, 500, 502, 503, 504, 520, 522, 524}
+
+
+def _backoff(attempt: int, response: requests.Response | None = None) -> float:
+    retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+    if retry_after.isdigit():
+        return min(float(retry_after), config.backoff_max)
+
+    return min(config.backoff_base * 2**attempt, config.backoff_max) * random.uniform(0.5, 1.0)
+
+
+class HostLimiter:
+    """Не даёт делать к хосту больше запросов в секунду, чем указано в `config.host_rates`."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._next: dict[str, float] = {}
+
+    def wait(self, url: str) -> None:
+        host = urlparse(url).hostname or ""
+        rate = config.host_rates.get(host)
+        if not rate:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next.get(host, 0.0))
+            self._next[host] = slot + 1 / rate
+        if slot > now:
+            time.sleep(slot - now)
+
+
+host_limiter = HostLimiter()
+
+
+def get_with_retries(url: str, session: requests.Session | None = None, **kwargs) -> requests.Response:
+    """GET с таймаутами и ограниченным числом повторов при временных ошибках сети и сервера.
+
+    Без `stream=True` тело ответа читается внутри цикла, поэтому обрыв при его получении тоже повторяется.
+    Потоковое тело так читает `download_with_retries`. Нетранзитные ответы (404, 403 и т.п.) возвращаются сразу,
+    решать что с ними делать - вызывающему.
+    """
+    return _retrying_get(url, session, None, **kwargs)[0]
+
+
+def download_with_retries(
+    url: str, read: Callable[[requests.Response], str], session: requests.Session | None = None, **kwargs
+) -> tuple[requests.Response, str | None]:
+    """Как `get_with_retries`, но потоково, и тело ответа 200 читает `read` внутри цикла повторов.
+
+    Обрыв соединения посреди тела повторяет весь запрос. Для остальных ответов `read` не вызывается.
+    """
+    return _retrying_get(url, session, read, stream=True, **kwargs)
+
+
+def _retrying_get(
+    url: str, session: requests.Session | None, read: Callable[[requests.Response], str] | None, **kwargs
+) -> tuple[requests.Response, str | None]:
+    getter = session.get if session is not None else requests.get
+    kwargs.setdefault("timeout", (config.connect_timeout, config.read_timeout))
+
+    for attempt in range(config.retries + 1):
+        response = None
+        try:
+            host_limiter.wait(url)
+            response = getter(url, **kwargs)
+            if not kwargs.get("stream"):
+                response.content
+            if response.status_code not in TRANSIENT_STATUSES:
+                body = read(response) if read is not None and response.status_code == 200 else None
+                return response, body
+            response.close()
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ):
+            if response is not None:
+                response.close()
+            if attempt == config.retries:
+                raise
+
+        if attempt < config.retries:
+            time.sleep(_backoff(attempt, response))
+
+    return response, None  # type: ignore
+
+
+# Одинаковые запросы, пришедшие одновременно (например, от нескольких сборок в `src.service`),
+# выполняются один раз. Для картинок общим получается и перекодирование.
+metadata_requests = SingleFlight()
+image_requests = SingleFlight()
+
+# Главы и картинки - идемпотентные GET с длинным хвостом задержек, медленные из них можно дублировать.
+chapter_hedger = Hedger()
+image_hedger = Hedger()
+
+
+def _get_shared(url: str, **kwargs) -> requests.Response:
+    """`get_with_retries` без потокового чтения через `metadata_requests`.
+
+    Ответ общий для всех ждавших, поэтому каждый разбирает `response.content` сам и получает свои объекты.
+    """
+    return metadata_requests.do((url, config.token), get_with_retries, url, **kwargs)
 
 
 def get_latest_release(owner, repo):
     url = f"https://api.github.com/repos/{owner}/{repo}/releases/latest"
-    response = requests.get(url)
+    response = requests.get(url, timeout=(config.connect_timeout, config.read_timeout))
     if response.ok:
-        data = response.json()
+        data = json_loads(response.content)
         return data["tag_name"]
     else:
         raise Exception(f"Ошибка запроса: {response.status_code} - {response.text}")
 
 
 def get_branchs(ranobe_id: str) -> dict | None:
-    url = f"{BASE_API_URL}/branches/{ranobe_id}?team_defaults=1"
+    url = f"{get_base_api_url()}/branches/{ranobe_id}?team_defaults=1"
 
-    response = requests.get(
+    response = _get_shared(
         url,
         headers={
             "Priority": "u=0",
@@ -47,7 +169,7 @@ def get_branchs(ranobe_id: str) -> dict | None:
             "Sec-Fetch-Dest": "empty",
             "Sec-Fetch-Mode": "cors",
             "Sec-Fetch-Site": "cross-site",
-            "Host": HOST,
+            "Host": get_api_host(),
             "Sec-Gpc": "1",
             "Site-Id": "3",
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36 Edg/131.0.0.0",
@@ -57,11 +179,11 @@ def get_branchs(ranobe_id: str) -> dict | None:
     if response.status_code != 200:
         return None
 
-    return response.json().get("data")
+    return json_loads(response.content).get("data")
 
 
 def get_ranobe_data(name: str) -> dict | None:
-    url_base = f"{BASE_API_URL}/manga/{name}?"
+    url_base = f"{get_base_api_url()}/manga/{name}?"
     url = url_base + "&".join(
         [
             f"fields[]={item}"
@@ -76,7 +198,7 @@ def get_ranobe_data(name: str) -> dict | None:
             ]
         ]
     )
-    response = requests.get(
+    response = _get_shared(
         url,
         headers={
             "Origin": "https://ranobelib.me",
@@ -85,7 +207,7 @@ def get_ranobe_data(name: str) -> dict | None:
             "Sec-Fetch-Dest": "empty",
             "Sec-Fetch-Mode": "cors",
             "Sec-Fetch-Site": "cross-site",
-            "Host": HOST,
+            "Host": get_api_host(),
             "Sec-Gpc": "1",
             "Site-Id": "3",
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36 Edg/131.0.0.0",
@@ -94,27 +216,39 @@ def get_ranobe_data(name: str) -> dict | None:
     if response.status_code != 200:
         return None
 
-    return response.json().get("data")
+    return json_loads(response.content).get("data")
 
 
 def get_chapters_data(name: str) -> list[ChapterMeta] | None:
-    url = f"{BASE_API_URL}/manga/{name}/chapters"
+    url = f"{get_base_api_url()}/manga/{name}/chapters"
 
-    response = requests.get(
+    response = _get_shared(
         url,
         headers={"Authorization": f"Bearer {config.token}"},
     )
     if response.status_code != 200:
         return None
     chapters = [
-        ChapterMeta(name=data.get("name"), number=data.get("number"), volume=data.get("volume"))
-        for data in response.json().get("data")
+        ChapterMeta(
+            name=data.get("name"),
+            number=data.get("number"),
+            volume=data.get("volume"),
+            branches=[str(branch.get("branch_id") or "") for branch in data.get("branches", [])],
+        )
+        for data in json_loads(response.content).get("data")
     ]
 
     return chapters
 
 
-def get_image_content(url: str, format: str, cover: bool = False) -> bytes:
+def get_image_content(url: str, format: str, cover: bool = False) -> StoredFile:
+    """Скачивает картинку и перекодирует её в `format`. Одновременные вызовы с теми же параметрами ждут первый."""
+    format = "JPEG" if format.upper() == "JPG" else format.upper()
+    key = (url, format, cover, config.image_quality)
+    return image_requests.do(key, image_hedger.call, _get_image_content, url, format, cover)
+
+
+def _get_image_content(url: str, format: str, cover: bool) -> StoredFile:
     headers = {
         "Client-Time-Zone": "Europe/Kyiv",
         "Connection": "keep-alive",
@@ -129,47 +263,60 @@ def get_image_content(url: str, format: str, cover: bool = False) -> bytes:
         "Site-Id": "3",
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:141.0) Gecko/20100101 Firefox/141.0",
     }
-    try:
-        if format.upper() == "JPG":
-            format = "JPEG"
+    # PIL нужен только для картинок, поэтому не грузим его при старте программы.
+    from PIL import Image, UnidentifiedImageError
 
+    try:
         if not is_url(url):
-            return b""
+            raise ImageSkipped(f"Некорректная ссылка на картинку {url=}. Пропускаем картинку.")
 
-        for _ in range(3):
-            try:
-                if cover:
-                    response = requests.get(url, headers=headers, stream=True, timeout=10)
-                else:
-                    scraper = cloudscraper.create_scraper()
-                    response = scraper.get(url, stream=True, timeout=10)
+        def read(response: requests.Response) -> str:
+            return image_store.download(response, config.image_max_size)
 
-                break
-            except requests.exceptions.ChunkedEncodingError:
-                continue
+        if cover:
+            response, raw_path = download_with_retries(url, read, headers=headers)
+        else:
+            response, raw_path = download_with_retries(url, read, session=get_scraper())
 
         match response.status_code:
             case 200:
-                with Image.open(io.BytesIO(response.content)) as img:
-                    with io.BytesIO() as io_buf:
-                        img.save(io_buf, format=format, quality=70)
-                        io_buf.seek(0)
-                        return io_buf.read()
+                out_path = image_store.temp_path()
+                try:
+                    with Image.open(raw_path) as img:
+                        img.save(out_path, format=format, quality=config.image_quality)
+                    return image_store.commit(out_path)
+                finally:
+                    for path in (raw_path, out_path):
+                        if os.path.exists(path):
+                            os.remove(path)
 
             case 404:
-                raise Exception(
+                raise ImageSkipped(
                     f"Error {response.status_code}: {response.reason}. {url=} \nКартинка не найдена по ссылке в API. Пропускаем картинку."
                 )
 
-            case _:
+            case status if status in TRANSIENT_STATUSES:
+                # Сервер не ответил и после повторов: может получиться позже, при повторной попытке главы.
                 raise Exception(
                     f"Error {response.status_code}: {response.reason}. {url=} \nНе удалось получить картинку. Пропускаем картинку."
                 )
 
-    except PIL.UnidentifiedImageError:
-        raise Exception("Что то не так с картинкой. Пропускаем картинку.")
+            case _:
+                raise ImageSkipped(
+                    f"Error {response.status_code}: {response.reason}. {url=} \nНе удалось получить картинку. Пропускаем картинку."
+                )
+
+    except ImageSkipped:
+        raise
 
-    except requests.exceptions.ChunkedEncodingError:
+    except UnidentifiedImageError:
+        raise ImageSkipped("Что то не так с картинкой. Пропускаем картинку.")
+
+    except (
+        requests.exceptions.ChunkedEncodingError,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+    ):
         raise Exception("Ошибка при получении картинки. Пропускаем картинку.")
 
     except Exception as e:
@@ -177,8 +324,10 @@ def get_image_content(url: str, format: str, cover: bool = False) -> bytes:
 
 
 def get_chapter(ranobe_name: str, priority_branch: str, number: int, volume: int) -> ChapterData:
-    url = f"{BASE_API_URL}/manga/{ranobe_name}/chapter?branch_id={priority_branch}&number={number}&volume={volume}"
-    response = requests.get(
+    branch_param = f"branch_id={priority_branch}&" if priority_branch else ""
+    url = f"{get_base_api_url()}/manga/{ranobe_name}/chapter?{branch_param}number={number}&volume={volume}"
+    response = chapter_hedger.call(
+        get_with_retries,
         url,
         headers={
             "Origin": "https://ranobelib.me",
@@ -187,7 +336,7 @@ def get_chapter(ranobe_name: str, priority_branch: str, number: int, volume: int
             "Sec-Fetch-Dest": "empty",
             "Sec-Fetch-Mode": "cors",
             "Sec-Fetch-Site": "cross-site",
-            "Host": HOST,
+            "Host": get_api_host(),
             "Sec-Gpc": "1",
             "Site-Id": "3",
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36 Edg/131.0.0.0",
@@ -196,36 +345,4 @@ def get_chapter(ranobe_name: str, priority_branch: str, number: int, volume: int
     if response.status_code != 200:
         raise Exception(f"Ошибка при получении главы {volume} - {number}. Пропускаем главу {volume} - {number}")
 
-    else:
-        data = response.json().get("data")
-
-        if isinstance(data.get("content"), str) and is_html(data.get("content")):
-            type = "html"
-            content = data.get("content")
-        else:
-            type = "doc"
-            content = data.get("content").get("content")
-
-        attachments = []
-        if len(data.get("attachments")):
-            for item in data.get("attachments"):
-                attachments.append(
-                    Attachment(
-                        id=item.get("id"),
-                        name=item.get("name"),
-                        url=item.get("url"),
-                        extension=item.get("extension"),
-                        filename=item.get("filename"),
-                        width=item.get("width"),
-                        height=item.get("height"),
-                    )
-                )
-
-        return ChapterData(
-            id=data.get("id"),
-            number=data.get("number"),
-            volume=data.get("volume"),
-            type=type,
-            content=content,
-            attachments=attachments,
-        )
+    return ChapterData(number=number, volume=volume, raw=response.content)
@@ -0,0 +1,96 @@
+import os
+import shutil
+import zlib
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Уже сжатые форматы: повторное сжатие почти ничего не даёт, а время на сохранении съедает заметно.
+STORED_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".woff", ".woff2")
+
+# Одна и та же дата у всех файлов, чтобы архив не зависел от времени сохранения.
+FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def _deflate(level: int, data: bytes) -> tuple[int, bytes]:
+    # Те же параметры, что и у самого zipfile: сырой deflate без заголовка zlib.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return zlib.crc32(data), compressor.compress(data) + compressor.flush()
+
+
+class ZipWriter(zipfile.ZipFile):
+    """ZIP-архив, который сжимает файлы параллельно и не зависит от числа потоков.
+
+    `writestr` и `write` только запоминают файлы. При закрытии текстовые файлы сжимаются в пуле потоков
+    (zlib отпускает GIL), а затем записываются в архив строго в порядке добавления. Уже сжатые форматы
+    (см. `STORED_EXTENSIONS`) кладутся без сжатия и копируются с диска потоком.
+    """
+
+    def __init__(self, file, compresslevel: int | None = None, workers: int = 0) -> None:
+        super().__init__(file, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+        self.workers = workers or os.cpu_count() or 1
+        self._pending: list[tuple[zipfile.ZipInfo, bytes | str]] = []
+
+    def _info(self, name: str, compress_type: int | None) -> zipfile.ZipInfo:
+        zinfo = zipfile.ZipInfo(name, FIXED_DATE_TIME)
+        zinfo.external_attr = 0o644 << 16
+        if compress_type is None:
+            compress_type = zipfile.ZIP_STORED if name.lower().endswith(STORED_EXTENSIONS) else self.compression
+        zinfo.compress_type = compress_type
+        return zinfo
+
+    def writestr(self, zinfo_or_arcname, data, compress_type=None, compresslevel=None) -> None:
+        name = zinfo_or_arcname if isinstance(zinfo_or_arcname, str) else zinfo_or_arcname.filename
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._pending.append((self._info(name, compress_type), data))
+
+    def write(self, filename, arcname=None, compress_type=None, compresslevel=None) -> None:
+        self._pending.append((self._info(arcname or os.path.basename(filename), compress_type), filename))
+
+    def _write_packed(self, zinfo: zipfile.ZipInfo, size: int, crc: int, packed: bytes) -> None:
+        """Дописывает в архив файл, уже сжатый заранее."""
+        zinfo.file_size = size
+        zinfo.compress_size = len(packed)
+        zinfo.CRC = crc
+        with self._lock:
+            self._writecheck(zinfo)
+            self._didModify = True
+            self.fp.seek(self.start_dir)
+            zinfo.header_offset = self.start_dir
+            self.fp.write(zinfo.FileHeader())
+            self.fp.write(packed)
+            self.start_dir = self.fp.tell()
+            self.filelist.append(zinfo)
+            self.NameToInfo[zinfo.filename] = zinfo
+
+    def _write_stream(self, zinfo: zipfile.ZipInfo, path: str) -> None:
+        zinfo.file_size = os.path.getsize(path)
+        with open(path, "rb") as src, self.open(zinfo, "w") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    def _flush(self) -> None:
+        pending, self._pending = self._pending, []
+        level = self.compresslevel if self.compresslevel is not None else zlib.Z_DEFAULT_COMPRESSION
+
+        def pack(entry: tuple[zipfile.ZipInfo, bytes | str]) -> tuple[int, int, bytes] | None:
+            zinfo, data = entry
+            if zinfo.compress_type != zipfile.ZIP_DEFLATED:
+                return None
+            if isinstance(data, str):
+                with open(data, "rb") as f:
+                    data = f.read()
+            return len(data), *_deflate(level, data)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for (zinfo, data), packed in zip(pending, pool.map(pack, pending)):
+                if packed is not None:
+                    self._write_packed(zinfo, *packed)
+                elif isinstance(data, str):
+                    self._write_stream(zinfo, data)
+                else:
+                    self._write_packed(zinfo, len(data), zlib.crc32(data), data)
+
+    def close(self) -> None:
+        if self.fp is not None and self._pending:
+            self._flush()
+        super().close()
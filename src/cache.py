@@ -0,0 +1,180 @@
+"""Кеш глав и картинок на диске и список отслеживаемых ранобэ.
+
+Главы хранятся в том виде, в каком их отдаёт API, картинки - уже перекодированными.
+Когда кеш больше `config.cache_max_size`, удаляются записи, которые дольше всего не читали.
+"""
+
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator
+
+from src.config import config
+from src.imagestore import image_store
+from src.model import ChapterData, ChapterMeta, StoredFile
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+-- Суммарный размер записей ("size"), чтобы не считать его заново при каждой записи.
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS watchlist (
+    slug TEXT PRIMARY KEY,
+    branch TEXT,
+    chapters INTEGER NOT NULL DEFAULT 0,
+    checked REAL
+);
+"""
+
+
+def chapter_key(slug: str, branch: str, chapter_meta: ChapterMeta) -> str:
+    return f"chapter:{slug}:{branch}:{chapter_meta.volume}:{chapter_meta.number}"
+
+
+def image_key(url: str, extension: str) -> str:
+    # Картинки хранятся перекодированными, поэтому качество входит в ключ, как и в `api.get_image_content`.
+    extension = "JPEG" if extension.upper() == "JPG" else extension.upper()
+    return f"image:{extension}:{config.image_quality}:{url}"
+
+
+class DiskCache:
+    def __init__(self, path: str | None = None) -> None:
+        self._path = path
+        # Файл базы, для которого уже созданы таблицы. Путь может поменяться при перечитывании профиля.
+        self._ready: Path | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self) -> Path:
+        if self._path:
+            return Path(self._path)
+        cache_dir = config.cache_dir or Path(config.data_dir or Path.home() / ".ranobe2ebook") / "cache"
+        return Path(cache_dir) / "cache.sqlite"
+
+    @property
+    def enabled(self) -> bool:
+        return config.cache_enabled
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        path = self.path
+        with self._lock:
+            if self._ready != path:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with sqlite3.connect(path) as db:
+                    # WAL: сборка может читать кеш, пока фоновая подкачка в него пишет.
+                    db.execute("PRAGMA journal_mode=WAL")
+                    db.executescript(SCHEMA)
+                    db.execute(
+                        "INSERT OR IGNORE INTO meta (key, value) SELECT 'size', COALESCE(SUM(size), 0) FROM entries"
+                    )
+                self._ready = path
+
+        db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def get(self, key: str) -> bytes | None:
+        with self._connect() as db:
+            row = db.execute("SELECT data FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time(), key))
+        return row[0] if row else None
+
+    def has(self, key: str) -> bool:
+        with self._connect() as db:
+            return db.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+
+    def put(self, key: str, data: bytes) -> None:
+        with self._connect() as db:
+            # Запись и общий размер меняются в одной транзакции, чтобы размер не разошёлся с записями.
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+                db.execute(
+                    "INSERT OR REPLACE INTO entries (key, data, size, used) VALUES (?, ?, ?, ?)",
+                    (key, data, len(data), time.time()),
+                )
+                self._add_size(db, len(data) - (row[0] if row else 0))
+                self._evict(db)
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    @staticmethod
+    def _add_size(db: sqlite3.Connection, delta: int) -> None:
+        db.execute("UPDATE meta SET value = value + ? WHERE key = 'size'", (delta,))
+
+    def _evict(self, db: sqlite3.Connection) -> None:
+        total = db.execute("SELECT value FROM meta WHERE key = 'size'").fetchone()[0]
+        if total <= config.cache_max_size:
+            return
+
+        # Освобождаем с запасом в 10%, чтобы не чистить кеш на каждой следующей записи.
+        excess = total - config.cache_max_size * 0.9
+        freed = 0
+        for key, size in db.execute("SELECT key, size FROM entries ORDER BY used").fetchall():
+            if freed >= excess:
+                break
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            freed += size
+        self._add_size(db, -freed)
+
+    def chapter(
+        self, slug: str, branch: str, chapter_meta: ChapterMeta, fetch: Callable[[], ChapterData]
+    ) -> ChapterData:
+        """Глава из кеша, а если её там нет - из `fetch`, с сохранением в кеш."""
+        key = chapter_key(slug, branch, chapter_meta)
+        raw = self.get(key)
+        if raw is not None:
+            return ChapterData(number=chapter_meta.number, volume=chapter_meta.volume, raw=raw)
+
+        chapter = fetch()
+        self.put(key, chapter.raw)
+        return chapter
+
+    def image(self, url: str, extension: str, fetch: Callable[[], StoredFile]) -> StoredFile:
+        key = image_key(url, extension)
+        data = self.get(key)
+        if data is not None:
+            return image_store.put(data)
+
+        stored = fetch()
+        self.put(key, stored.read())
+        return stored
+
+    def watch(self, slug: str, branch: str | None) -> None:
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO watchlist (slug, branch) VALUES (?, ?) ON CONFLICT (slug) DO UPDATE SET branch = ?",
+                (slug, branch, branch),
+            )
+
+    def unwatch(self, slug: str) -> bool:
+        with self._connect() as db:
+            return db.execute("DELETE FROM watchlist WHERE slug = ?", (slug,)).rowcount > 0
+
+    def watched(self) -> list[tuple[str, str | None, int, float | None]]:
+        """Отслеживаемые ранобэ: slug, ветка, сколько глав с начала списка уже подкачано и когда была проверка."""
+        with self._connect() as db:
+            return db.execute("SELECT slug, branch, chapters, checked FROM watchlist ORDER BY slug").fetchall()
+
+    def checked(self, slug: str, chapters: int) -> None:
+        with self._connect() as db:
+            db.execute("UPDATE watchlist SET chapters = ?, checked = ? WHERE slug = ?", (chapters, time.time(), slug))
+
+
+disk_cache = DiskCache()
@@ -0,0 +1,80 @@
+import threading
+from concurrent.futures import Future, InvalidStateError
+from typing import Any, Callable
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancelToken:
+    """Флаг отмены, общий для всех потоков одной сборки книги.
+
+    Блокирующие вызовы (запросы, скачивание картинок) выполняются через `call` в отдельном потоке:
+    при отмене ждущий поток сразу получает `Cancelled`, а сам запрос дорабатывает в фоне до своего таймаута
+    и его результат выбрасывается.
+    """
+
+    def __init__(self) -> None:
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._futures: set[Future] = set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self) -> None:
+        self._event.set()
+        with self._lock:
+            futures, self._futures = self._futures, set()
+        for future in futures:
+            try:
+                future.set_exception(Cancelled())
+            except InvalidStateError:
+                pass
+
+    def check(self) -> None:
+        if self.cancelled:
+            raise Cancelled()
+
+    def wait(self, timeout: float) -> bool:
+        """Спит `timeout` секунд, но просыпается сразу при отмене. Возвращает True, если отменили."""
+        return self._event.wait(timeout)
+
+    def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        self.check()
+        future: Future = Future()
+
+        def target() -> None:
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                try:
+                    future.set_exception(e)
+                except InvalidStateError:
+                    pass
+                return
+
+            try:
+                future.set_result(result)
+            except InvalidStateError:
+                # Вызов уже отменили и результат никому не нужен: освобождаем соединение.
+                if hasattr(result, "close"):
+                    result.close()
+
+        with self._lock:
+            self._futures.add(future)
+        if not self.cancelled:
+            threading.Thread(target=target, daemon=True).start()
+        else:
+            try:
+                future.set_exception(Cancelled())
+            except InvalidStateError:
+                pass
+
+        try:
+            return future.result()
+        finally:
+            with self._lock:
+                self._futures.discard(future)
@@ -0,0 +1,148 @@
+"""Запуск без интерфейса.
+
+    python -m src.cli jobs create --db jobs.sqlite https://ranobelib.me/ru/book/slug
+    python -m src.cli jobs work --db jobs.sqlite
+    python -m src.cli jobs status --db jobs.sqlite 1
+    python -m src.cli jobs assemble --db jobs.sqlite 1 --format epub --out books
+
+    python -m src.cli serve --port 8700 --cache
+
+    python -m src.cli watch add https://ranobelib.me/ru/book/slug
+    python -m src.cli watch run --window 01:00-07:00
+
+`jobs work` можно запускать сразу на нескольких машинах, если файл базы лежит на общем диске.
+"""
+
+import argparse
+import multiprocessing
+
+from src.handler import HANDLERS, load_handler
+from src.profile import ProfileError, load_profile
+
+
+def _jobs(args: argparse.Namespace) -> None:
+    from src.jobs import JobStore, assemble, create_job, run_worker
+
+    store = JobStore(args.db)
+    if args.action == "create":
+        job_id = create_job(store, args.url, args.branch, args.start, args.amount)
+        print(f"Задание {job_id}: блоков {sum(store.progress(job_id).values())}")
+    elif args.action == "work":
+        done = run_worker(store, args.job, args.worker)
+        print(f"Обработано блоков: {done}")
+    elif args.action == "status":
+        print(store.progress(args.job))
+    elif args.action == "assemble":
+        handler = assemble(
+            store,
+            args.job,
+            load_handler(args.format),
+            args.out,
+            wait=not args.no_wait,
+            timeout=args.timeout,
+            with_images=not args.no_images,
+            split_mode=args.split_mode,
+            split_value=args.split_value,
+        )
+        if handler.failed:
+            print(f"\nНе удалось скачать глав: {len(handler.failed)}")
+
+
+def _serve(args: argparse.Namespace) -> None:
+    from src.config import config
+    from src.service import serve
+
+    if args.cache:
+        config.cache_enabled = True
+    serve(args.host, args.port, args.unix)
+
+
+def _watch(args: argparse.Namespace) -> None:
+    import time
+
+    from src.cache import disk_cache
+    from src.config import config
+    from src.runner import slug_from_url
+    from src.watch import run_prefetcher
+
+    if args.action == "add":
+        disk_cache.watch(slug_from_url(args.url), args.branch)
+    elif args.action == "remove":
+        if not disk_cache.unwatch(slug_from_url(args.url)):
+            print("Это ранобэ не отслеживается.")
+    elif args.action == "list":
+        for slug, branch, chapters, checked in disk_cache.watched():
+            when = time.strftime("%Y-%m-%d %H:%M", time.localtime(checked)) if checked else "не проверялось"
+            print(f"{slug}  ветка: {branch or 'любая'}  подкачано глав: {chapters}  проверено: {when}")
+    elif args.action == "run":
+        if args.window is not None:
+            config.prefetch_window = args.window
+        run_prefetcher(once=args.once)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--profile", help="профиль производительности (TOML), см. `src.profile`")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    jobs = commands.add_parser("jobs", help="распределённое скачивание через общий файл SQLite")
+    actions = jobs.add_subparsers(dest="action", required=True)
+
+    create = actions.add_parser("create", help="создать задание")
+    create.add_argument("url", help="ссылка на ранобэ или её slug")
+    create.add_argument("--branch", help="приоритетная ветка перевода")
+    create.add_argument("--start", type=int, default=1, help="с какой главы начинать")
+    create.add_argument("--amount", type=int, default=0, help="сколько глав скачать, 0 - все")
+
+    work = actions.add_parser("work", help="скачивать блоки, пока они есть")
+    work.add_argument("--job", type=int, help="только это задание")
+    work.add_argument("--worker", default="", help="имя рабочего в базе, по умолчанию хост:pid")
+
+    status = actions.add_parser("status", help="сколько блоков в каком состоянии")
+    status.add_argument("job", type=int)
+
+    build = actions.add_parser("assemble", help="собрать книгу из скачанных блоков")
+    build.add_argument("job", type=int)
+    build.add_argument("--format", choices=tuple(HANDLERS), default="epub")
+    build.add_argument("--out", default=".", help="каталог для готовой книги")
+    build.add_argument("--no-wait", action="store_true", help="собирать, не дожидаясь всех блоков")
+    build.add_argument("--timeout", type=float, help="ждать блоки не дольше, секунд (по умолчанию job_wait_timeout)")
+    build.add_argument("--no-images", action="store_true")
+    build.add_argument("--split-mode", choices=("none", "volume", "chapters", "size"), default="none")
+    build.add_argument("--split-value", type=int, default=0)
+
+    for action in (create, work, status, build):
+        action.add_argument("--db", required=True, help="файл базы заданий")
+    jobs.set_defaults(func=_jobs)
+
+    serve = commands.add_parser("serve", help="локальный сервис сборки книг, см. `src.service`")
+    serve.add_argument("--host", default="", help="по умолчанию config.service_host")
+    serve.add_argument("--port", type=int, default=0, help="по умолчанию config.service_port")
+    serve.add_argument("--unix", default="", help="слушать Unix-сокет вместо TCP")
+    serve.add_argument("--cache", action="store_true", help="брать главы и картинки из кеша на диске, см. `watch`")
+    serve.set_defaults(func=_serve)
+
+    watch = commands.add_parser("watch", help="отслеживаемые ранобэ и подкачка новых глав в кеш")
+    watch_actions = watch.add_subparsers(dest="action", required=True)
+    watch_add = watch_actions.add_parser("add", help="отслеживать ранобэ")
+    watch_add.add_argument("url", help="ссылка на ранобэ или её slug")
+    watch_add.add_argument("--branch", help="приоритетная ветка перевода")
+    watch_remove = watch_actions.add_parser("remove", help="перестать отслеживать")
+    watch_remove.add_argument("url")
+    watch_actions.add_parser("list", help="список отслеживаемых")
+    watch_run = watch_actions.add_parser("run", help="подкачивать новые главы")
+    watch_run.add_argument("--once", action="store_true", help="проверить один раз и выйти")
+    watch_run.add_argument("--window", help='окно подкачки "ЧЧ:ММ-ЧЧ:ММ", по умолчанию config.prefetch_window')
+    watch.set_defaults(func=_watch)
+
+    args = parser.parse_args()
+    try:
+        load_profile(args.profile)
+    except ProfileError as e:
+        parser.exit(2, f"{e}\n")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
@@ -1,17 +1,94 @@
 import os
 import re
-import time
+import zipfile
 from xml.etree import ElementTree as ET
 
 from bs4 import BeautifulSoup
 from ebooklib import epub
 
-from src.model import ChapterData, ChapterMeta, Image, Handler
-from src.api import get_chapter, get_image_content
+from src.archive import ZipWriter
+from src.config import config
+from src.handler import Handler
+from src.model import ChapterData, ChapterMeta, Image, RenderTask, StoredFile
+from src.api import get_image_content
 
 
-class EpubHandler(Handler):
-    book: epub.EpubBook
+class StoredEpubImage(epub.EpubImage):
+    """Картинка, содержимое которой читается с диска только в момент записи книги."""
+
+    def __init__(self, file: StoredFile, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.file = file
+
+    def get_content(self, default=None) -> bytes:
+        return self.file.read()
+
+
+class EpubWriter(epub.EpubWriter):
+    """Пишет книгу через `ZipWriter`: картинки без сжатия прямо с диска, остальное сжимается параллельно."""
+
+    def write(self) -> None:
+        self.out = ZipWriter(
+            self.file_name, compresslevel=self.options["compresslevel"], workers=config.compress_workers
+        )
+        self.out.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+
+        self._write_container()
+        self._write_opf()
+        self._write_items()
+
+        self.out.close()
+
+    def _write_items(self) -> None:
+        folder = self.book.FOLDER_NAME
+        for item in self.book.get_items():
+            if isinstance(item, epub.EpubNcx):
+                self.out.writestr(f"{folder}/{item.file_name}", self._get_ncx())
+            elif isinstance(item, epub.EpubNav):
+                self.out.writestr(f"{folder}/{item.file_name}", self._get_nav(item))
+            elif isinstance(item, StoredEpubImage):
+                self.out.write(item.file.path, f"{folder}/{item.file_name}", compress_type=zipfile.ZIP_STORED)
+            elif item.manifest:
+                self.out.writestr(f"{folder}/{item.file_name}", item.get_content())
+            else:
+                self.out.writestr(item.file_name, item.get_content())
+
+
+def write_epub(file_path: str, book: epub.EpubBook) -> None:
+    """Сохраняет книгу с учётом `config.save_profile`.
+
+    Профиль "fast" сжимает текст минимальным уровнем и не размечает страницы EPUB3 (для этого
+    ebooklib заново разбирает каждую главу).
+    """
+    fast = config.save_profile == "fast"
+    writer = EpubWriter(
+        file_path,
+        book,
+        {
+            "compresslevel": 1 if fast else config.compress_level,
+            "epub3_pages": not fast,
+            "raise_exceptions": True,
+        },
+    )
+    writer.process()
+    writer.write()
+
+
+# Общие для всех глав стили: вместо одинаковых style="..." в каждом абзаце и цитате.
+BOOK_CSS = """blockquote { background-color: rgba(0, 0, 0, 0.2); padding: 10px 20px; border-radius: 15px; }
+hr { width: 100%; }
+.center { text-align: center; }
+.right { text-align: right; }
+.justify { text-align: justify; }
+"""
+
+# Разделитель частей длинной главы в результате отрисовки. В XHTML нулевого байта быть не может.
+PART_SEPARATOR = b"\0"
+
+
+class EpubRenderer:
+    """Отрисовывает главу в XHTML. Не трогает книгу и интерфейс, поэтому может работать в отдельном процессе."""
+
     style_tags = {
         "bold": "b",
         "italic": "i",
@@ -19,6 +96,15 @@ class EpubHandler(Handler):
         "strike": "del",
     }
 
+    def __init__(self, images: dict[str, str], with_images: bool, split_size: int = 0) -> None:
+        self.images = images
+        self.with_images = with_images
+        self.split_size = split_size
+
+    def _image(self, key: str) -> ET.Element:
+        src = self.images.get(key)
+        return ET.Element("img", attrib={"src": src}) if src and self.with_images else ET.Element("span")
+
     def _parse_html(self, chapter: ChapterData) -> list[ET.Element]:
         soup = BeautifulSoup(chapter.content, "html.parser")
         tags: list[ET.Element] = []
@@ -26,41 +112,12 @@ class EpubHandler(Handler):
             if tag.name == "p":
                 tag.attrs.pop("data-paragraph-index", None)
             if tag.name == "img":
-                url = tag["src"]
-                img_filename = url.split("/")[-1]
-                img_uid = f"{chapter.id}_{img_filename}"
-                try:
-                    content = get_image_content(url, img_filename.split(".")[-1])
-                    image = Image(
-                        uid=img_uid,
-                        extension=img_filename.split(".")[-1],
-                        content=content,
-                    )
-                    imageE = self._insert_image(image) if self.with_images else ET.Element("span")
-                    tags.append(imageE)
-                except Exception as e:
-                    self.log_func("Ошибка: " + str(e))
-
+                tags.append(self._image(tag["src"]))
                 continue
             tags.append(ET.fromstring(str(tag)))
 
         return tags
 
-    def _insert_image(self, image: Image) -> ET.Element:
-        for item in self.book.items:
-            if isinstance(item, epub.EpubImage) and item.content == image.content:
-                return ET.Element("img", attrib={"src": item.file_name})
-
-        self.book.add_item(
-            epub.EpubImage(
-                uid=image.uid,
-                file_name=image.static_url,
-                media_type=image.media_type,
-                content=image.content,
-            )
-        )
-        return ET.Element("img", attrib={"src": image.static_url})
-
     def _parse_marks(self, marks: list, tag: ET.Element, text: str, _index: int = 0) -> ET.Element:
         if _index >= len(marks):
             tag.text = text
@@ -75,9 +132,9 @@ class EpubHandler(Handler):
         paragraphE = ET.Element(element)
 
         attrs = paragraph.get("attrs")
-        if attrs:
-            aling = attrs.get("textAlign")
-            paragraphE.attrib["style"] = f"text-align: {aling or 'left'};"
+        if attrs and attrs.get("textAlign") in ("center", "right", "justify"):
+            # Выравнивание по левому краю - поведение по умолчанию, его не пишем.
+            paragraphE.attrib["class"] = attrs["textAlign"]
 
         if "content" not in paragraph:
             return paragraphE
@@ -106,23 +163,17 @@ class EpubHandler(Handler):
 
         return listE
 
-    def _tag_parser(self, tag: dict, **kwargs) -> ET.Element:
+    def _tag_parser(self, tag: dict) -> ET.Element:
         tag_type = tag.get("type")
         match tag_type:
             case "image":
-                images: dict[str, Image] = kwargs.get("images")
-                if not images:
-                    return ET.Element("span")
-                img_name = tag.get("attrs").get("images")[-1].get("image")
-                img = images.get(img_name)
-
-                return self._insert_image(img) if img and self.with_images else ET.Element("span")
+                return self._image(tag.get("attrs").get("images")[-1].get("image"))
 
             case "paragraph":
                 return self._parse_paragraph(tag)
 
             case "horizontalRule":
-                return ET.Element("hr", attrib={"style": "width: 100%;"})
+                return ET.Element("hr")
 
             case "bulletList" | "orderedList":
                 list_items = tag.get("content")
@@ -134,67 +185,19 @@ class EpubHandler(Handler):
                 return self._parse_paragraph(tag, "h" + str(level))
 
             case "blockquote":
-                blockquoteE = ET.Element(
-                    "blockquote",
-                    attrib={"style": "background-color: rgba(0, 0, 0, 0.2); padding: 10px 20px; border-radius: 15px;"},
-                )
+                blockquoteE = ET.Element("blockquote")
                 for b_tag in tag.get("content"):
-                    blockquoteE.append(self._tag_parser(b_tag, kwargs=kwargs))
+                    blockquoteE.append(self._tag_parser(b_tag))
                 return blockquoteE
 
     def _parse_doc(self, chapter: ChapterData) -> list[ET.Element]:
-        attachments = chapter.attachments
-        img_base_url = "https://ranobelib.me"
-        images: dict[str, Image] = {}
-        tags: list[ET.Element] = []
-
-        for attachment in attachments:
-            img_uid = f"{chapter.id}_{attachment.filename}"
-            try:
-                content = get_image_content(img_base_url + attachment.url, attachment.extension)
-            except Exception as e:
-                self.log_func("Ошибка: " + str(e))
-                continue
+        return [self._tag_parser(item) for item in chapter.content]
 
-            images[attachment.name] = Image(
-                uid=img_uid,
-                extension=attachment.extension,
-                content=content,
-            )
-
-        for item in chapter.content:
-            tmp = self._tag_parser(item, images=images)
-            tags.append(tmp)
-
-        return tags
-
-    def _make_chapter(self, slug: str, priority_branch: str, item: ChapterMeta) -> epub.EpubHtml | None:
-        try:
-            chapter: ChapterData = get_chapter(
-                slug,
-                priority_branch,
-                item.number,
-                item.volume,
-            )
-        except Exception as e:
-            self.log_func("Ошибка: " + str(e))
-            return None
-
-        chapter_title = f"Том {item.volume}. Глава {item.number}. {item.name}"
-
-        epub_chapter = epub.EpubHtml(
-            title=chapter_title,
-            file_name=item.number + "_" + item.volume + ".xhtml",
-        )
-
-        tags: list[ET.Element] = []
+    def render(self, chapter: ChapterData, title: str) -> bytes:
         if chapter.type == "html":
-            tags: list[str] = self._parse_html(chapter)
-        elif chapter.type == "doc":
-            tags: list[ET.Element] = self._parse_doc(chapter)
+            tags = self._parse_html(chapter)
         else:
-            self.log_func("Неизвестный тип главы! Невозможно преобразовать в EPUB!")
-            return None
+            tags = self._parse_doc(chapter)
 
         hmtl_str = "".join([ET.tostring(tag, encoding="unicode", method="html") for tag in tags])
 
@@ -203,58 +206,104 @@ class EpubHandler(Handler):
             if not span.attrs:
                 span.unwrap()
 
-        epub_chapter.set_content(f"<h1>{chapter_title}</h1>" + str(soup))
-
-        return epub_chapter
+        blocks = [f"<h1>{title}</h1>".encode("utf-8")] + [str(block).encode("utf-8") for block in soup.contents]
+        return PART_SEPARATOR.join(self._split(blocks))
 
-    def fill_book(
-        self,
-        slug: str,
-        priority_branch: str,
-        chapters_data: list[ChapterMeta],
-        worker,
-        delay: float = 0.5,
-    ) -> None:
-        self.max_chapter = str(chapters_data[-1].number)
-        self.min_chapter = str(chapters_data[0].number)
+    def _split(self, blocks: list[bytes]) -> list[bytes]:
+        """Собирает блоки верхнего уровня в части не больше `split_size` байт. Блоки не разрезаются."""
+        if not self.split_size:
+            return [b"".join(blocks)]
 
-        total_len = len(str(len(chapters_data)))
-        chap_len = len(str(max(chapters_data, key=lambda x: len(str(x.number))).number))
-        volume_len = len(str(chapters_data[-1].volume))
+        parts: list[bytes] = []
+        part: list[bytes] = []
+        size = 0
+        for block in blocks:
+            if part and size + len(block) > self.split_size:
+                parts.append(b"".join(part))
+                part, size = [], 0
+            part.append(block)
+            size += len(block)
+        parts.append(b"".join(part))
+        return parts
 
-        self.log_func(f"\nНачинаем скачивать главы: {len(chapters_data)}")
 
-        for i, chapter_meta in enumerate(chapters_data, 1):
-            time.sleep(delay)
-            if worker.is_cancelled:
-                break
+def render_chapter(task: RenderTask) -> bytes:
+    return EpubRenderer(task.images, task.with_images, task.split_size).render(task.chapter, task.title)
 
-            chapter = self._make_chapter(slug, priority_branch, chapter_meta)
-            if chapter:
-                self.book.add_item(chapter)
 
-                self.log_func(
-                    f"Скачали {i:>{total_len}}: Том {chapter_meta.volume:>{volume_len}}. Глава {chapter_meta.number:>{chap_len}}. {chapter_meta.name}"
-                )
-            else:
-                self.log_func("Пропускаем главу.")
+class EpubHandler(Handler):
+    book: epub.EpubBook
+    cover: bytes | None = None
+    image_files: dict[str, str]
+    chapters: list[tuple[ChapterMeta, epub.EpubHtml]]
+    css: epub.EpubItem
+    render = staticmethod(render_chapter)
 
-            self.progress_bar_step(1)
+    def _insert_image(self, image: Image) -> str:
+        file_name = self.image_files.get(image.file.digest)
+        if file_name:
+            return file_name
 
-    def save_book(self, dir: str) -> None:
-        safe_title = re.sub(r'[<>:"/\\|?*]', "", self.book.title)
+        self.book.add_item(
+            StoredEpubImage(
+                file=image.file,
+                uid=image.uid,
+                file_name=image.static_url,
+                media_type=image.media_type,
+            )
+        )
+        self.image_files[image.file.digest] = image.static_url
+        self.part_size += image.file.size
+        return image.static_url
+
+    def _add_chapter(self, chapter_meta: ChapterMeta, content: bytes) -> None:
+        # Длинная глава приходит несколькими частями: каждая становится отдельным документом,
+        # а в оглавление попадает только первый.
+        for i, part in enumerate(content.split(PART_SEPARATOR)):
+            suffix = f"_{i}" if i else ""
+            epub_chapter = epub.EpubHtml(
+                title=self._chapter_title(chapter_meta),
+                file_name=chapter_meta.number + "_" + chapter_meta.volume + suffix + ".xhtml",
+            )
+            epub_chapter.set_content(part)
+            epub_chapter.add_item(self.css)
+            self.book.add_item(epub_chapter)
+            if not i:
+                self.chapters.append((chapter_meta, epub_chapter))
+
+    def _save_part(self, book: epub.EpubBook, dir: str, label: str) -> None:
+        safe_title = re.sub(r'[<>:"/\\|?*]', "", book.title)
+        if label:
+            safe_title = f"{safe_title} ({label})"
         file_path = os.path.join(dir, f"{safe_title}.epub")
-        epub.write_epub(file_path, self.book)
+        write_epub(file_path, book)
 
-        self.log_func(f"Книга {self.book.title} сохранена в формате Epub.")
+        self.log_func(f"Книга {book.title} сохранена в формате Epub.")
         self.log_func(f"В каталоге {dir} создана книга {safe_title}.epub.")
-        self.book = None  # type: ignore
 
-    def end_book(self) -> None:
-        self.book.toc = (epub.Section("1"),) + tuple(  # type: ignore
-            chap for chap in self.book.items if isinstance(chap, epub.EpubHtml)
+    def _toc(self) -> tuple:
+        """Оглавление по томам. В режиме "compact" в нём только тома, без глав."""
+        volumes: dict[str, list[epub.EpubHtml]] = {}
+        for chapter_meta, chapter in self.chapters:
+            volumes.setdefault(chapter_meta.volume, []).append(chapter)
+
+        if len(volumes) <= 1:
+            return (epub.Section("1"),) + tuple(chap for _, chap in self.chapters)
+
+        if config.toc_mode == "compact":
+            return tuple(
+                epub.Link(chapters[0].file_name, f"Том {volume}", f"volume_{volume}")
+                for volume, chapters in volumes.items()
+            )
+
+        return tuple(
+            (epub.Section(f"Том {volume}", href=chapters[0].file_name), tuple(chapters))
+            for volume, chapters in volumes.items()
         )
 
+    def end_book(self) -> None:
+        self.book.toc = self._toc()  # type: ignore
+
         self.book.add_item(epub.EpubNcx())
         self.book.add_item(epub.EpubNav())
         self.book.spine = [chap for chap in self.book.items if isinstance(chap, epub.EpubHtml)]
@@ -269,11 +318,16 @@ class EpubHandler(Handler):
 
     def make_book(self, ranobe_data: dict) -> None:
         self.log_func("\nПодготавливаем книгу...")
+        self.ranobe_data = ranobe_data
+        self.image_files = {}
+        self.chapters = []
+        self.css = epub.EpubItem(uid="style", file_name="style/book.css", media_type="text/css", content=BOOK_CSS)
 
         title = ranobe_data.get("rus_name") if ranobe_data.get("rus_name") else ranobe_data.get("name")
 
         book: epub.EpubBook = epub.EpubBook()
         book.set_title(title)
+        book.add_item(self.css)
 
         book.set_language("ru")
         for author in ranobe_data.get("authors"):  # type: ignore
@@ -281,9 +335,9 @@ class EpubHandler(Handler):
 
         cover_url = ranobe_data.get("cover").get("default")  # type: ignore
         try:
-            book.set_cover(
-                cover_url.split("/")[-1], get_image_content(cover_url, cover_url.split(".")[-1], True), False
-            )
+            if self.cover is None:
+                self.cover = get_image_content(cover_url, cover_url.split(".")[-1], True).read()
+            book.set_cover(cover_url.split("/")[-1], self.cover, False)
         except Exception as e:
             self.log_func(f"Не удалось скачать обложку: {e}")
 
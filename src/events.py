@@ -0,0 +1,37 @@
+import threading
+from collections import deque
+
+
+class EventBus:
+    """Очередь событий от обработчиков к интерфейсу.
+
+    Обработчики пишут в неё из рабочих потоков, а приложение забирает накопившееся по таймеру
+    одним обновлением экрана. Очередь строк лога ограничена, шаги прогресса складываются в одно число.
+    """
+
+    def __init__(self, max_lines: int = 1000) -> None:
+        self._lock = threading.Lock()
+        self._lines: deque[str] = deque(maxlen=max_lines)
+        self._dropped = 0
+        self._progress = 0.0
+
+    def log(self, text: str) -> None:
+        with self._lock:
+            if len(self._lines) == self._lines.maxlen:
+                self._dropped += 1
+            self._lines.append(text)
+
+    def advance(self, step: float = 1) -> None:
+        with self._lock:
+            self._progress += step
+
+    def drain(self) -> tuple[list[str], int, float]:
+        """Забирает накопленные строки, число выброшенных из-за переполнения строк и сумму шагов прогресса."""
+        with self._lock:
+            lines = list(self._lines)
+            dropped, progress = self._dropped, self._progress
+            self._lines.clear()
+            self._dropped = 0
+            self._progress = 0.0
+
+        return lines, dropped, progress
@@ -1,56 +1,110 @@
 import os
 import re
-import time
+import zipfile
+from base64 import b64encode
 from dataclasses import dataclass, field
+from typing import BinaryIO, Iterable
 from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape, quoteattr
 
-from FB2 import FictionBook2dataclass, SimpleChapter, Image as FB2Image
+from FB2 import FictionBook2dataclass, Image as FB2Image
 from FB2.FB2Builder import FB2Builder
 from bs4 import BeautifulSoup
 
-from src.model import ChapterData, ChapterMeta, Handler, Image
-from src.api import get_chapter, get_image_content
+from src.archive import FIXED_DATE_TIME
+from src.config import config
+from src.handler import Handler
+from src.model import ChapterData, ChapterMeta, Image, RenderTask
+from src.api import get_image_content
 from src.utils import set_authors
 
+FB2_NAMESPACE = "http://www.gribuser.ru/xml/fictionbook/2.0"
+XLINK_NAMESPACE = "http://www.w3.org/1999/xlink"
+
+# Секции глав попадают в файл как есть, поэтому ссылки на картинки в них должны быть с тем же префиксом,
+# что и в описании.
+ET.register_namespace("xlink", XLINK_NAMESPACE)
+
 
 @dataclass
 class MyFictionBook2dataclass(FictionBook2dataclass.FictionBook2dataclass):
     images: list[Image] = field(default_factory=list)
+    sections: list[tuple[str, bytes]] = field(default_factory=list)
 
 
 class MyFB2Builder(FB2Builder):
     book: MyFictionBook2dataclass
 
-    def _AddBody(self, root: ET.Element) -> None:
-        if len(self.book.chapters):
-            bodyElement = ET.SubElement(root, "body")
-            for chapter in self.book.chapters:
-                bodyElement.append(self._BuildSectionFromChapter(chapter))
-
-    def _AddBinaries(self, root: ET.Element) -> None:
-        if self.book.titleInfo.coverPageImages is not None:
-            for i, coverImage in enumerate(self.book.titleInfo.coverPageImages):
-                self._AddBinary(root, coverImage.uid, coverImage.media_type, coverImage.content)
-        if self.book.sourceTitleInfo and self.book.sourceTitleInfo.coverPageImages:
-            for i, coverImage in enumerate(self.book.sourceTitleInfo.coverPageImages):
-                self._AddBinary(root, coverImage.uid, coverImage.media_type, coverImage.content)
-        if len(self.book.images) > 0:
-            for image in self.book.images:
-                self._AddBinary(root, image.uid, image.media_type, image.content)
+    def GetHead(self) -> ET.Element:
+        """Всё, что идёт перед телом книги. Тело и картинки MyFictionBook2.write пишет сам, по одной секции."""
+        root = ET.Element("FictionBook")
+        self._AddStylesheets(root)
+        self._AddCustomInfos(root)
+        self._AddDescription(root)
+        return root
 
 
 @dataclass
 class MyFictionBook2(MyFictionBook2dataclass):
     def write(self, filename: str):
-        with open(filename, "w", encoding="utf-8") as f:
-            f.write(str(self))
-
-    def __str__(self) -> str:
-        return MyFB2Builder._PrettifyXml(MyFB2Builder(self).GetFB2())
-
+        with open(filename, "wb") as f:
+            self.write_to(f)
+
+    def write_zip(self, filename: str, arcname: str) -> None:
+        """Пишет книгу сразу в сжатый архив, не создавая несжатой копии ни на диске, ни в памяти."""
+        level = 1 if config.save_profile == "fast" else config.compress_level
+        zinfo = zipfile.ZipInfo(arcname, FIXED_DATE_TIME)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.external_attr = 0o644 << 16
+        with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED, compresslevel=level) as archive:
+            # Размер заранее неизвестен, поэтому сразу разрешаем zip64 на случай книг больше 2 ГБ.
+            with archive.open(zinfo, "w", force_zip64=True) as f:
+                self.write_to(f)
+
+    def write_to(self, f: BinaryIO) -> None:
+        """Пишет книгу в поток по одному элементу: описание, секции глав в том виде, в котором их
+        отдала отрисовка, и картинки кусками прямо из файлов на диске. Целиком книга в памяти не собирается.
+        """
+        f.write(b'<?xml version="1.0" encoding="utf-8"?>\n')
+        f.write(f"<FictionBook xmlns={quoteattr(FB2_NAMESPACE)} xmlns:xlink={quoteattr(XLINK_NAMESPACE)}>\n".encode())
+        for element in MyFB2Builder(self).GetHead():
+            ET.indent(element, "\t", level=1)
+            f.write(b"\t" + ET.tostring(element, encoding="unicode").encode("utf-8") + b"\n")
+
+        if self.sections:
+            f.write(b"\t<body>\n")
+            # Если томов несколько, главы складываются в секцию тома - читалки строят оглавление по вложенности.
+            nested = len({volume for volume, _ in self.sections}) > 1
+            current_volume = None
+            for volume, section in self.sections:
+                if nested and volume != current_volume:
+                    if current_volume is not None:
+                        f.write(b"\t\t</section>\n")
+                    f.write(f"\t\t<section><title><p>{escape(f'Том {volume}')}</p></title>\n".encode())
+                    current_volume = volume
+                f.write(b"\t\t" + section + b"\n")
+            if nested:
+                f.write(b"\t\t</section>\n")
+            f.write(b"\t</body>\n")
+
+        for info in (self.titleInfo, self.sourceTitleInfo):
+            for cover in (info.coverPageImages or []) if info else []:
+                self._write_binary(f, cover.uid, cover.media_type, [cover.content])
+        for image in self.images:
+            self._write_binary(f, image.uid, image.media_type, image.file.iter_chunks())
+        f.write(b"</FictionBook>\n")
+
+    @staticmethod
+    def _write_binary(f: BinaryIO, uid: str, media_type: str, chunks: Iterable[bytes]) -> None:
+        f.write(f"\t<binary id={quoteattr(uid)} content-type={quoteattr(media_type)}>".encode())
+        for chunk in chunks:
+            f.write(b64encode(chunk))
+        f.write(b"</binary>\n")
+
+
+class FB2Renderer:
+    """Отрисовывает главу в секцию FB2. Не трогает книгу и интерфейс, поэтому может работать в отдельном процессе."""
 
-class FB2Handler(Handler):
-    book: MyFictionBook2
     style_tags = {
         "bold": "strong",
         "italic": "emphasis",
@@ -58,6 +112,16 @@ class FB2Handler(Handler):
         "strike": "strikethrough",
     }
 
+    def __init__(self, images: dict[str, str], with_images: bool) -> None:
+        self.images = images
+        self.with_images = with_images
+
+    def _image(self, key: str) -> ET.Element:
+        href = self.images.get(key)
+        if not href or not self.with_images:
+            return ET.Element("custom")
+        return ET.Element("image", attrib={f"{{{XLINK_NAMESPACE}}}href": href})
+
     def _parse_html(self, chapter: ChapterData) -> list[ET.Element]:
         soup = BeautifulSoup(chapter.content, "html.parser")
         tags: list[ET.Element] = []
@@ -65,33 +129,12 @@ class FB2Handler(Handler):
             if tag.name == "p":
                 tag.attrs.pop("data-paragraph-index", None)
             if tag.name == "img":
-                url = tag["src"]
-                img_filename = url.split("/")[-1]
-                img_uid = f"{chapter.id}_{img_filename}"
-                try:
-                    content = get_image_content(url, img_filename.split(".")[-1])
-                    image = Image(
-                        uid=img_uid,
-                        extension=img_filename.split(".")[-1],
-                        content=content,
-                    )
-                    imageE = self._insert_image(image) if self.with_images else ET.Element("custom")
-                    tags.append(imageE)
-                except Exception as e:
-                    self.log_func("Ошибка: " + str(e))
+                tags.append(self._image(tag["src"]))
                 continue
             tags.append(ET.fromstring(str(tag)))
 
         return tags
 
-    def _insert_image(self, image: Image) -> ET.Element:
-        for img in self.book.images:
-            if img.content == image.content:
-                return ET.Element("image", attrib={"{http://www.w3.org/1999/xlink}href": f"#{img.uid}"})
-
-        self.book.images.append(image)
-        return ET.Element("image", attrib={"{http://www.w3.org/1999/xlink}href": f"#{image.uid}"})
-
     def _parse_marks(self, marks: list, tag: ET.Element, text: str, _index: int = 0) -> ET.Element:
         if _index >= len(marks):
             tag.text = text
@@ -108,9 +151,9 @@ class FB2Handler(Handler):
         paragraphE = ET.Element(element)
 
         attrs = paragraph.get("attrs")
-        if attrs:
-            aling = attrs.get("textAlign")
-            paragraphE.attrib["align"] = aling or "left"
+        if attrs and attrs.get("textAlign") in ("center", "right", "justify"):
+            # Выравнивание по левому краю - поведение по умолчанию, его не пишем.
+            paragraphE.attrib["align"] = attrs["textAlign"]
 
         if "content" not in paragraph:
             return paragraphE
@@ -150,12 +193,7 @@ class FB2Handler(Handler):
         item_type = tag.get("type")
         match item_type:
             case "image":
-                images: dict[str, Image] = kwargs.get("images")
-                if not images:
-                    return ET.Element("custom")
-                img_name = tag.get("attrs").get("images")[-1].get("image")
-                img = images.get(img_name)
-                return self._insert_image(img) if img and self.with_images else ET.Element("custom")
+                return self._image(tag.get("attrs").get("images")[-1].get("image"))
 
             case "paragraph":
                 return self._parse_paragraph(tag)
@@ -180,111 +218,69 @@ class FB2Handler(Handler):
             case "blockquote":
                 blockquoteE = ET.Element("epigraph")
                 for b_tag in tag.get("content"):
-                    blockquoteE.append(self._tag_parser(b_tag, kwargs=kwargs))
+                    blockquoteE.append(self._tag_parser(b_tag, **kwargs))
                 return blockquoteE
 
     def _parse_doc(self, chapter: ChapterData) -> list[ET.Element]:
-        attachments = chapter.attachments
-        img_base_url = "https://ranobelib.me"
-        images: dict[str, Image] = {}
-
-        for attachment in attachments:
-            img_uid = f"{chapter.id}_{attachment.filename}"
-            try:
-                content = get_image_content(img_base_url + attachment.url, attachment.extension)
-            except Exception as e:
-                self.log_func("Ошибка: " + str(e))
-                continue
-
-            images[attachment.name] = Image(
-                uid=img_uid,
-                extension=attachment.extension,
-                content=content,
-            )
-
-        tags: list[ET.Element] = []
-        for item in chapter.content:
-            tag: ET.Element = self._tag_parser(item, images=images)
-            tags.append(tag)
-        return tags
-
-    def _make_chapter(self, slug: str, priority_branch: str, chapter_meta: ChapterMeta) -> SimpleChapter | None:
-        try:
-            chapter: ChapterData = get_chapter(
-                slug,
-                priority_branch,
-                chapter_meta.number,
-                chapter_meta.volume,
-            )
-        except Exception as e:
-            self.log_func("Ошибка: " + str(e))
-            return None
-
-        tags: list[ET.Element] = []
+        return [self._tag_parser(item) for item in chapter.content]
 
+    def render(self, chapter: ChapterData, title: str) -> bytes:
         if chapter.type == "html":
             tags = self._parse_html(chapter)
-        elif chapter.type == "doc":
-            tags = self._parse_doc(chapter)
         else:
-            self.log_func("Неизвестный тип главы! Невозможно преобразовать в FB2!")
-            return None
+            tags = self._parse_doc(chapter)
 
-        clean_tags: list[str] = []
+        sectionElement = ET.Element("section")
+        ET.SubElement(ET.SubElement(sectionElement, "title"), "p").text = title
         for element in tags:
             text_tag = ET.tostring(element)
             soup = BeautifulSoup(text_tag, "html.parser")
             for custom in soup.find_all("custom"):
                 custom.unwrap()
-            clean_tags.append(str(soup))
-
-        clean_elements = [ET.fromstring(tag) for tag in clean_tags]
-
-        chapter_title = f"Том {chapter_meta.volume}. Глава {chapter_meta.number}. {chapter_meta.name}"
-        return SimpleChapter(chapter_title, content=clean_elements)
+            clean_tag = str(soup)
+            if clean_tag:
+                # После разворачивания <custom> (например у списков) элементов может стать несколько,
+                # а объявление пространства имён ссылок на картинки могло остаться на развёрнутом теге.
+                namespaces = " ".join(sorted(set(re.findall(r'xmlns:\w+="[^"]*"', text_tag.decode("ascii")))))
+                sectionElement.extend(ET.fromstring(f"<custom {namespaces}>{clean_tag}</custom>"))
 
-    def fill_book(
-        self,
-        slug: str,
-        priority_branch: str,
-        chapters_data: list[ChapterMeta],
-        worker,
-        delay: float = 0.5,
-    ) -> None:
-        self.max_chapter = str(chapters_data[-1].number)
-        self.min_chapter = str(chapters_data[0].number)
+        return ET.tostring(sectionElement, encoding="unicode").encode("utf-8")
 
-        len_total = len(str(len(chapters_data)))
-        chap_len = len(str(max(chapters_data, key=lambda x: len(str(x.number))).number))
-        volume_len = len(str(chapters_data[-1].volume))
 
-        self.log_func(f"Начинаем скачивать главы: {len(chapters_data)}")
+def render_chapter(task: RenderTask) -> bytes:
+    return FB2Renderer(task.images, task.with_images).render(task.chapter, task.title)
 
-        for i, chapter_meta in enumerate(chapters_data, 1):
-            time.sleep(delay)
-            if worker.is_cancelled:
-                break
 
-            chapter: SimpleChapter | None = self._make_chapter(slug, priority_branch, chapter_meta)
-
-            if chapter:
-                self.book.chapters.append(chapter)
-
-                self.log_func(
-                    f"Скачали {i:>{len_total}}: Том {chapter_meta.volume:>{volume_len}}. Глава {chapter_meta.number:>{chap_len}}. {chapter_meta.name}"
-                )
-            else:
-                self.log_func("Пропускаем главу.")
+class FB2Handler(Handler):
+    book: MyFictionBook2
+    cover: bytes | None = None
+    compressed: bool = False
+    render = staticmethod(render_chapter)
 
-            self.progress_bar_step(1)
+    def _insert_image(self, image: Image) -> str:
+        for img in self.book.images:
+            if img.file.digest == image.file.digest:
+                return f"#{img.uid}"
 
-    def save_book(self, dir: str) -> None:
-        safe_title = re.sub(r'[<>:"/\\|?*]', "", self.book.titleInfo.title)
-        file_path = os.path.join(dir, f"{safe_title}.fb2")
-        self.book.write(file_path)
-        self.log_func(f"Книга {self.book.titleInfo.title} сохранена в формате FB2!")
-        self.log_func(f"В каталоге {dir} создана книга {safe_title}.fb2")
-        self.book = None
+        self.book.images.append(image)
+        self.part_size += image.file.size * 4 // 3
+        return f"#{image.uid}"
+
+    def _add_chapter(self, chapter_meta: ChapterMeta, content: bytes) -> None:
+        self.book.sections.append((chapter_meta.volume, content))
+
+    def _save_part(self, book: MyFictionBook2, dir: str, label: str) -> None:
+        safe_title = re.sub(r'[<>:"/\\|?*]', "", book.titleInfo.title)
+        if label:
+            safe_title = f"{safe_title} ({label})"
+        file_name = f"{safe_title}.fb2.zip" if self.compressed else f"{safe_title}.fb2"
+        file_path = os.path.join(dir, file_name)
+        if self.compressed:
+            book.write_zip(file_path, f"{safe_title}.fb2")
+        else:
+            book.write(file_path)
+        self.log_func(f"Книга {book.titleInfo.title} сохранена в формате FB2!")
+        self.log_func(f"В каталоге {dir} создана книга {file_name}")
 
     def end_book(self) -> None:
         self.book.titleInfo.sequences = [
@@ -296,6 +292,7 @@ class FB2Handler(Handler):
 
     def make_book(self, ranobe_data: dict) -> None:
         self.log_func("Подготавливаем книгу...")
+        self.ranobe_data = ranobe_data
 
         title = ranobe_data.get("rus_name") if ranobe_data.get("rus_name") else ranobe_data.get("name")
         book = MyFictionBook2()
@@ -308,12 +305,17 @@ class FB2Handler(Handler):
         book.customInfos = ["meta", "rating"]
         cover_url = ranobe_data.get("cover").get("default")
         try:
-            cover_image = get_image_content(cover_url, cover_url.split(".")[-1], True)
+            if self.cover is None:
+                self.cover = get_image_content(cover_url, cover_url.split(".")[-1], True).read()
             book.titleInfo.coverPageImages = [
-                FB2Image(content=cover_image, media_type=f"image/{cover_url.split('.')[-1]}")
+                FB2Image(content=self.cover, media_type=f"image/{cover_url.split('.')[-1]}")
             ]
         except Exception as e:
             self.log_func(f"Не удалось скачать обложку: {e}")
 
         self.log_func("Подготовили книгу.")
         self.book = book
+
+
+class FB2ZipHandler(FB2Handler):
+    compressed = True
@@ -0,0 +1,426 @@
+import importlib
+import multiprocessing
+import os
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from contextlib import nullcontext
+from typing import Any, Callable, Literal
+
+from src.api import get_chapter, get_image_content
+from src.cache import chapter_key, disk_cache
+from src.cancel import Cancelled, CancelToken
+from src.config import config
+from src.imagestore import ImageSkipped
+from src.model import ChapterData, ChapterMeta, Image, RenderTask, StoredFile
+
+
+class Handler(ABC):
+    log_func: Callable
+    progress_bar_step: Callable
+
+    min_chapter: str
+    max_chapter: str
+
+    with_images: bool
+    book: Any
+
+    split_mode: Literal["none", "volume", "chapters", "size"] = "none"
+    split_value: int = 0
+    save_dir: str = ""
+
+    ranobe_data: dict
+    part: int = 0
+    part_label: str = ""
+    part_size: int = 0
+    # Отрисовки текущей части, размер которых ещё не учтён в `part_size`. Считаются в потоке `fill_book`.
+    unsized: list[Future]
+    part_chapters: list[tuple[ChapterMeta, Future | None]]
+    retry_queue: list[int]
+    failed: list[str]
+    image_errors: int = 0
+    cancel: CancelToken
+    # Общий пул отрисовки (например, у `src.service`). Без него на каждую сборку создаётся свой.
+    render_pool: ProcessPoolExecutor | None = None
+    # Раундов повторных попыток в конце части. None - `config.deferred_retry_rounds`.
+    deferred_retry_rounds: int | None = None
+
+    # Отрисовка главы в байты. Должна быть функцией уровня модуля, чтобы её можно было отдать в другой процесс.
+    render: Callable[[RenderTask], bytes]
+
+    def __init__(self, log_func: Callable, progress_bar_step: Callable) -> None:
+        self.log_func = log_func
+        self.progress_bar_step = progress_bar_step
+        self.cancel = CancelToken()
+
+    @abstractmethod
+    def _insert_image(self, image: Image) -> str:
+        """Добавляет картинку в книгу и возвращает ссылку на неё для отрисовки."""
+        pass
+
+    @abstractmethod
+    def _add_chapter(self, chapter_meta: ChapterMeta, content: bytes) -> None:
+        pass
+
+    @abstractmethod
+    def _save_part(self, book: Any, dir: str, label: str) -> None:
+        pass
+
+    @abstractmethod
+    def make_book(self, ranobe_data: dict) -> None:
+        pass
+
+    @abstractmethod
+    def end_book(self) -> None:
+        pass
+
+    def save_book(self, dir: str) -> None:
+        if self.book is None:
+            return
+        self._save_part(self.book, dir, self.part_label)
+        self.book = None
+
+    @staticmethod
+    def _chapter_title(chapter_meta: ChapterMeta) -> str:
+        return f"Том {chapter_meta.volume}. Глава {chapter_meta.number}. {chapter_meta.name}"
+
+    def _fetch_chapter(self, slug: str, branch: str, chapter_meta: ChapterMeta) -> ChapterData:
+        """Откуда берутся главы. По умолчанию - из API (через `disk_cache`, если он включён),
+        см. `src.jobs` для сборки из общего хранилища."""
+
+        def fetch() -> ChapterData:
+            return self.cancel.call(get_chapter, slug, branch, chapter_meta.number, chapter_meta.volume)
+
+        return disk_cache.chapter(slug, branch, chapter_meta, fetch) if disk_cache.enabled else fetch()
+
+    def _fetch_image(self, url: str, extension: str) -> StoredFile:
+        def fetch() -> StoredFile:
+            return self.cancel.call(get_image_content, url, extension)
+
+        return disk_cache.image(url, extension, fetch) if disk_cache.enabled else fetch()
+
+    def _delay(self, slug: str, priority_branch: str, chapter_meta: ChapterMeta, delay: float) -> float:
+        """Пауза перед запросом главы. Если глава уже есть в `disk_cache`, к API не обращаемся и ждать незачем."""
+        branch = chapter_meta.branch if chapter_meta.branch is not None else priority_branch
+        if disk_cache.enabled and disk_cache.has(chapter_key(slug, branch, chapter_meta)):
+            return 0
+        return delay
+
+    def _prepare_images(self, chapter: ChapterData) -> dict[str, str]:
+        """Скачивает картинки главы параллельно (не больше `config.image_workers` за раз).
+
+        В книгу они добавляются уже в этом потоке и в порядке следования в главе, поэтому
+        содержимое книги не зависит от того, какая картинка скачалась первой.
+        """
+        images: dict[str, str] = {}
+        if not self.with_images:
+            # Без картинок главу не нужно разбирать здесь: тело ответа разберёт процесс отрисовки.
+            return images
+
+        sources = chapter.image_sources
+        if not sources:
+            return images
+
+        with ThreadPoolExecutor(max_workers=max(1, min(config.image_workers, len(sources)))) as pool:
+            downloads = [
+                (key, filename, extension, pool.submit(self._fetch_image, url, extension))
+                for key, url, filename, extension in sources
+            ]
+
+            for key, filename, extension, download in downloads:
+                try:
+                    image = Image(
+                        uid=f"{chapter.id}_{filename}",
+                        extension=extension,
+                        file=download.result(),
+                    )
+                except Cancelled:
+                    raise
+                except ImageSkipped as e:
+                    # Повтор главы эту картинку не вернёт.
+                    self.log_func("Ошибка: " + str(e))
+                    continue
+                except Exception as e:
+                    self.image_errors += 1
+                    self.log_func("Ошибка: " + str(e))
+                    continue
+
+                images[key] = self._insert_image(image)
+
+        return images
+
+    def _make_chapter(self, slug: str, branch: str, chapter_meta: ChapterMeta) -> RenderTask | None:
+        """Скачивает главу и её картинки. Сама отрисовка выполняется отдельно, см. `render`."""
+        try:
+            chapter: ChapterData = self._fetch_chapter(slug, branch, chapter_meta)
+        except Cancelled:
+            raise
+        except Exception as e:
+            self.log_func("Ошибка: " + str(e))
+            return None
+
+        return RenderTask(
+            chapter=chapter,
+            title=self._chapter_title(chapter_meta),
+            images=self._prepare_images(chapter),
+            with_images=self.with_images,
+            split_size=config.chapter_split_size,
+        )
+
+    def _render_pool(self) -> ProcessPoolExecutor | nullcontext:
+        if self.render_pool is not None:
+            return nullcontext(self.render_pool)
+
+        workers = config.render_workers or os.cpu_count() or 1
+        if workers <= 1:
+            return nullcontext()
+
+        # spawn, а не fork: процесс интерфейса многопоточный, а fork из такого процесса может зависнуть.
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _render(self, pool: ProcessPoolExecutor | None, task: RenderTask) -> Future:
+        if pool is not None:
+            future = pool.submit(self.render, task)
+        else:
+            future = Future()
+            try:
+                future.set_result(self.render(task))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.unsized.append(future)
+        return future
+
+    def _count_sizes(self) -> None:
+        """Добавляет к `part_size` размер отрисованных глав текущей части.
+
+        Граница части зависит от этого размера, поэтому ещё не готовые отрисовки дожидаемся. Обычно они
+        успевают закончиться за паузу перед следующей главой.
+        """
+        for future in self.unsized:
+            try:
+                self.part_size += len(future.result())
+            except Exception:
+                # Ошибку отрисовки покажет `_close_part`.
+                pass
+        self.unsized = []
+
+    def _is_new_part(self, chapter_meta: ChapterMeta) -> bool:
+        if not self.part_chapters:
+            return False
+
+        match self.split_mode:
+            case "volume":
+                return chapter_meta.volume != self.part_chapters[-1][0].volume
+            case "chapters":
+                return len(self.part_chapters) >= self.split_value > 0
+            case "size":
+                self._count_sizes()
+                return self.part_size >= self.split_value * 1024 * 1024 > 0
+            case _:
+                return False
+
+    def _start_part(self, chapter_meta: ChapterMeta) -> None:
+        if self.book is None:
+            self.make_book(self.ranobe_data)
+
+        self.part += 1
+        self.part_size = 0
+        self.unsized = []
+        self.min_chapter = str(chapter_meta.number)
+        match self.split_mode:
+            case "volume":
+                self.part_label = f"Том {chapter_meta.volume}"
+            case "chapters" | "size":
+                self.part_label = f"Часть {self.part}"
+            case _:
+                self.part_label = ""
+
+    def _try_chapter(
+        self, slug: str, priority_branch: str, chapter_meta: ChapterMeta, pool: ProcessPoolExecutor | None
+    ) -> tuple[Future | None, bool]:
+        """Запускает сборку главы и сообщает, получилась ли она полностью (вместе со всеми картинками)."""
+        self.image_errors = 0
+        branch = chapter_meta.branch if chapter_meta.branch is not None else priority_branch
+        try:
+            task = self._make_chapter(slug, branch, chapter_meta)
+        except Cancelled:
+            return None, False
+        except Exception as e:
+            self.log_func(f"Ошибка при сборке главы: {e}")
+            task = None
+
+        if task is None:
+            return None, False
+
+        future, complete = self._render(pool, task), self.image_errors == 0
+        future.add_done_callback(lambda future: self._on_rendered(chapter_meta, future, complete))
+        return future, complete
+
+    def _on_rendered(self, chapter_meta: ChapterMeta, future: Future, complete: bool) -> None:
+        """Глава отрисована (или отрисовка не удалась). Вызывается из потока пула, см. `src.library`."""
+        pass
+
+    def _stopped(self, worker) -> bool:
+        return self.cancel.cancelled or (worker is not None and worker.is_cancelled)
+
+    def _retry_deferred(self, slug: str, priority_branch: str, worker, pool: ProcessPoolExecutor | None) -> None:
+        """Повторно обрабатывает пропущенные главы и главы с картинками, не скачанными из-за временных ошибок."""
+        rounds = config.deferred_retry_rounds if self.deferred_retry_rounds is None else self.deferred_retry_rounds
+        for attempt in range(1, rounds + 1):
+            if not self.retry_queue or self._stopped(worker):
+                break
+
+            self.log_func(f"\nПовторная попытка {attempt}: глав в очереди - {len(self.retry_queue)}")
+            if self.cancel.wait(config.deferred_retry_delay):
+                break
+
+            queue, self.retry_queue = self.retry_queue, []
+            for index in queue:
+                if self._stopped(worker):
+                    self.retry_queue.append(index)
+                    continue
+
+                chapter_meta, old_chapter = self.part_chapters[index]
+                chapter, complete = self._try_chapter(slug, priority_branch, chapter_meta, pool)
+                if self.cancel.cancelled and chapter is None:
+                    self.retry_queue.append(index)
+                    continue
+                if chapter and (complete or old_chapter is None):
+                    self.part_chapters[index] = (chapter_meta, chapter)
+                if not complete:
+                    self.retry_queue.append(index)
+                else:
+                    self.log_func(f"Докачали: Том {chapter_meta.volume}. Глава {chapter_meta.number}.")
+
+        for index in self.retry_queue:
+            chapter_meta, chapter = self.part_chapters[index]
+            reason = "не удалось скачать" if chapter is None else "не все картинки"
+            self.failed.append(f"{self._chapter_title(chapter_meta)} - {reason}")
+        self.retry_queue = []
+
+    def _close_part(self, slug: str, priority_branch: str, worker, pool: ProcessPoolExecutor | None) -> None:
+        self._retry_deferred(slug, priority_branch, worker, pool)
+
+        # После отмены ждём уже запущенную отрисовку не дольше `config.cancel_drain_timeout` на всю часть.
+        deadline = time.monotonic() + config.cancel_drain_timeout
+        for chapter_meta, chapter in self.part_chapters:
+            if chapter is None:
+                continue
+
+            try:
+                timeout = max(0.0, deadline - time.monotonic()) if self.cancel.cancelled else None
+                content = chapter.result(timeout=timeout)
+            except (TimeoutError, CancelledError):
+                chapter.cancel()
+                self.failed.append(f"{self._chapter_title(chapter_meta)} - не успели отрисовать до остановки")
+                continue
+            except Exception as e:
+                self.log_func(f"Ошибка при сборке главы: {e}")
+                self.failed.append(f"{self._chapter_title(chapter_meta)} - ошибка при сборке")
+                continue
+
+            self._add_chapter(chapter_meta, content)
+        self.part_chapters = []
+
+    def _finish_part(self, pool: ThreadPoolExecutor) -> None:
+        """Завершает текущую часть и отдаёт её на сохранение в фоне, освобождая память под следующую."""
+        self.end_book()
+        book, label = self.book, self.part_label
+        self.book = None
+
+        future = pool.submit(self._save_part, book, self.save_dir, label)
+        future.add_done_callback(self._on_part_saved)
+
+    def _on_part_saved(self, future: Future) -> None:
+        if future.exception():
+            self.log_func(f"Не удалось сохранить часть книги: {future.exception()}")
+
+    def _log_summary(self) -> None:
+        if not self.failed:
+            return
+
+        self.log_func(f"\nНе удалось докачать полностью: {len(self.failed)}")
+        for line in self.failed:
+            self.log_func(line)
+
+    def fill_book(
+        self,
+        slug: str,
+        priority_branch: str,
+        chapters_data: list[ChapterMeta],
+        worker=None,
+        delay: float | None = None,
+    ) -> None:
+        delay = config.request_delay if delay is None else delay
+        self.max_chapter = str(chapters_data[-1].number)
+        self.min_chapter = str(chapters_data[0].number)
+        self.part_chapters = []
+        self.unsized = []
+        self.retry_queue = []
+        self.failed = []
+
+        total_len = len(str(len(chapters_data)))
+        chap_len = len(str(max(chapters_data, key=lambda x: len(str(x.number))).number))
+        volume_len = len(str(chapters_data[-1].volume))
+
+        self.log_func(f"\nНачинаем скачивать главы: {len(chapters_data)}")
+
+        with ThreadPoolExecutor(max_workers=config.save_workers) as save_pool, self._render_pool() as render_pool:
+            for i, chapter_meta in enumerate(chapters_data, 1):
+                if self.cancel.wait(self._delay(slug, priority_branch, chapter_meta, delay)) or self._stopped(worker):
+                    break
+
+                if self._is_new_part(chapter_meta):
+                    self._close_part(slug, priority_branch, worker, render_pool)
+                    self._finish_part(save_pool)
+
+                if not self.part_chapters:
+                    self._start_part(chapter_meta)
+
+                chapter, complete = self._try_chapter(slug, priority_branch, chapter_meta, render_pool)
+                if self.cancel.cancelled and chapter is None:
+                    # Главу прервали на середине: в книгу она не попадёт, в список недокачанных тоже.
+                    if not self.part_chapters and self.part > 1:
+                        # Новая часть так и не началась, сохранять пустую книгу незачем.
+                        self.book = None
+                    break
+                self.max_chapter = str(chapter_meta.number)
+                self.part_chapters.append((chapter_meta, chapter))
+                if not complete:
+                    self.retry_queue.append(len(self.part_chapters) - 1)
+
+                if chapter:
+                    self.log_func(
+                        f"Скачали {i:>{total_len}}: Том {chapter_meta.volume:>{volume_len}}. Глава {chapter_meta.number:>{chap_len}}. {chapter_meta.name}"
+                    )
+                else:
+                    self.log_func("Пропускаем главу. Попробуем ещё раз в конце.")
+
+                self.progress_bar_step(1)
+
+            if self.cancel.cancelled:
+                self.log_func("\nСкачивание остановлено, сохраняем то, что успели.")
+                if render_pool is not None and render_pool is not self.render_pool:
+                    render_pool.shutdown(wait=False, cancel_futures=True)
+                else:
+                    # Общий пул останавливать нельзя, снимаем из очереди только свои главы.
+                    for _, future in self.part_chapters:
+                        if future is not None:
+                            future.cancel()
+            self._close_part(slug, priority_branch, worker, render_pool)
+
+        self._log_summary()
+
+
+# Форматы по имени: "модуль:класс". Модуль формата (и его тяжёлые зависимости) импортируется только при выборе формата.
+HANDLERS: dict[str, str] = {
+    "epub": "src.epub:EpubHandler",
+    "fb2": "src.fb2:FB2Handler",
+    "fb2.zip": "src.fb2:FB2ZipHandler",
+}
+
+
+def load_handler(name: str, handlers: dict[str, str] = HANDLERS) -> type[Handler]:
+    module, cls = handlers[name].split(":")
+    return getattr(importlib.import_module(module), cls)
@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Any, Callable
+
+from src.config import config
+
+
+class LatencyTracker:
+    """Последние `size` длительностей успешных запросов."""
+
+    def __init__(self, size: int = 200) -> None:
+        self._lock = threading.Lock()
+        self._samples: deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, p: float) -> float:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+
+def _start(latency: LatencyTracker, func: Callable[..., Any], *args, **kwargs) -> Future:
+    future: Future = Future()
+
+    def target() -> None:
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            # Учитываем и проигравшие запросы, иначе процентиль со временем занижался бы.
+            latency.add(time.monotonic() - start)
+            future.set_result(result)
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+
+def _discard(future: Future) -> None:
+    # Проигравший запрос дорабатывает в фоне, его ответ никому не нужен: освобождаем соединение.
+    def close(future: Future) -> None:
+        if future.exception() is None and hasattr(future.result(), "close"):
+            future.result().close()
+
+    future.add_done_callback(close)
+
+
+class Hedger:
+    """Дублирует медленные идемпотентные запросы.
+
+    Если ответа нет дольше, чем `config.hedge_percentile` от недавних длительностей таких же запросов,
+    отправляется второй такой же запрос, и берётся тот ответ, что придёт первым. Дублей не больше
+    `config.hedge_budget` от общего числа запросов. С `config.hedge_percentile` = 0 запросы идут как обычно.
+    """
+
+    def __init__(self) -> None:
+        self.latency = LatencyTracker()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedged = 0
+        self.won = 0
+
+    def _delay(self) -> float | None:
+        """Сколько ждать перед дублем или None, если дублировать нельзя."""
+        if not config.hedge_percentile or len(self.latency) < config.hedge_min_samples:
+            return None
+        return max(self.latency.percentile(config.hedge_percentile), config.hedge_min_delay)
+
+    def _take_budget(self) -> bool:
+        with self._lock:
+            if self.hedged + 1 > config.hedge_budget * self.requests:
+                return False
+            self.hedged += 1
+            return True
+
+    def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            self.requests += 1
+
+        delay = self._delay()
+        if delay is None:
+            start = time.monotonic()
+            result = func(*args, **kwargs)
+            self.latency.add(time.monotonic() - start)
+            return result
+
+        primary = _start(self.latency, func, *args, **kwargs)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_budget():
+            return primary.result()
+
+        backup = _start(self.latency, func, *args, **kwargs)
+        pending = {primary, backup}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            succeeded = [future for future in done if future.exception() is None]
+            if succeeded or not pending:
+                # Ошибку отдаём, только если оба запроса завершились ошибкой.
+                winner = succeeded[0] if succeeded else done.pop()
+                for other in pending | done - {winner}:
+                    _discard(other)
+                if winner is backup and succeeded:
+                    with self._lock:
+                        self.won += 1
+                return winner.result()
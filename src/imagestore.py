@@ -0,0 +1,94 @@
+import atexit
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+import requests
+
+from src.model import StoredFile
+
+
+class ImageSkipped(Exception):
+    """Картинку не получить и повтором (404, битый файл и т.п.): её пропускают, а главу не перекачивают."""
+
+
+class ImageTooLarge(ImageSkipped):
+    pass
+
+
+class ImageStore:
+    """Хранит скачанные картинки во временных файлах, чтобы в памяти оставались только пути и хеши.
+
+    Файлы с одинаковым содержимым хранятся один раз: имя итогового файла - это его sha1.
+    Каталог удаляется при завершении программы.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, root: str | None = None) -> None:
+        self.root = root
+        self._dir: str | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def dir(self) -> str:
+        with self._lock:
+            if self._dir is None:
+                if self.root:
+                    os.makedirs(self.root, exist_ok=True)
+                self._dir = tempfile.mkdtemp(prefix="ranobe2ebook-images-", dir=self.root)
+                atexit.register(shutil.rmtree, self._dir, True)
+            return self._dir
+
+    def temp_path(self) -> str:
+        return os.path.join(self.dir, f"{uuid.uuid4().hex}.part")
+
+    def download(self, response: requests.Response, max_size: int) -> str:
+        """Потоково сохраняет тело ответа во временный файл и прерывает загрузку, если он больше `max_size`."""
+        length = response.headers.get("Content-Length", "")
+        if length.isdigit() and int(length) > max_size:
+            response.close()
+            raise ImageTooLarge(f"Картинка больше {max_size // (1024 * 1024)} МБ. Пропускаем картинку.")
+
+        path = self.temp_path()
+        size = 0
+        try:
+            with open(path, "wb") as f:
+                for chunk in response.iter_content(self.chunk_size):
+                    size += len(chunk)
+                    if size > max_size:
+                        raise ImageTooLarge(f"Картинка больше {max_size // (1024 * 1024)} МБ. Пропускаем картинку.")
+                    f.write(chunk)
+        except BaseException:
+            response.close()
+            os.remove(path)
+            raise
+
+        return path
+
+    def put(self, data: bytes) -> StoredFile:
+        """Сохраняет уже полученные в память данные, например картинку из общего хранилища `src.jobs`."""
+        path = self.temp_path()
+        with open(path, "wb") as f:
+            f.write(data)
+        return self.commit(path)
+
+    def commit(self, path: str) -> StoredFile:
+        """Переносит готовый временный файл в хранилище под именем его хеша."""
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                digest.update(chunk)
+
+        stored_path = os.path.join(self.dir, digest.hexdigest())
+        if os.path.exists(stored_path):
+            os.remove(path)
+        else:
+            os.replace(path, stored_path)
+        return StoredFile(path=stored_path, digest=digest.hexdigest(), size=os.path.getsize(stored_path))
+
+
+image_store = ImageStore()
@@ -0,0 +1,386 @@
+"""Распределённое скачивание через общий файл SQLite.
+
+Координатор (`create_job`) разбивает главы ранобэ на блоки. Любое число рабочих (`run_worker`) на одной
+или нескольких машинах забирают блоки из общего файла, скачивают главы и картинки и пишут их обратно.
+Затем `assemble` собирает книгу обычным `fill_book`, только главы и картинки берутся из хранилища, а не из API.
+
+Блок выдаётся в аренду на `config.job_lease` секунд, и пока рабочий его скачивает, аренда продлевается.
+Если рабочий упал, блок снова станет доступен другим, а результаты рабочего, потерявшего аренду, не записываются.
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from src.api import get_chapter, get_image_content
+from src.config import config
+from src.handler import Handler
+from src.imagestore import image_store
+from src.model import ChapterData, ChapterMeta, StoredFile
+from src.profile import reload_profile
+from src.runner import build_book, load_title, select_chapters, slug_from_url
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    slug TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    ranobe_data TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS units (
+    job_id INTEGER NOT NULL,
+    unit INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    claimed_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (job_id, unit)
+);
+CREATE TABLE IF NOT EXISTS chapters (
+    job_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    unit INTEGER NOT NULL,
+    volume TEXT NOT NULL,
+    number TEXT NOT NULL,
+    meta TEXT NOT NULL,
+    raw BLOB,
+    error TEXT,
+    PRIMARY KEY (job_id, position)
+);
+CREATE INDEX IF NOT EXISTS chapters_number ON chapters (job_id, volume, number);
+CREATE TABLE IF NOT EXISTS images (
+    job_id INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    digest TEXT,
+    error TEXT,
+    PRIMARY KEY (job_id, url)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+"""
+
+
+def _dump_meta(chapter_meta: ChapterMeta) -> str:
+    return json.dumps(
+        {
+            "name": chapter_meta.name,
+            "number": chapter_meta.number,
+            "volume": chapter_meta.volume,
+            "branches": chapter_meta.branches,
+            "branch": chapter_meta.branch,
+        }
+    )
+
+
+def _load_meta(meta: str) -> ChapterMeta:
+    return ChapterMeta(**json.loads(meta))
+
+
+class JobStore:
+    """Задания, блоки глав и скачанные данные в одном файле SQLite."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # Отдельное соединение на каждую операцию: файл может лежать на общем диске, долго держать его открытым незачем.
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def create_job(
+        self, slug: str, priority_branch: str, ranobe_data: dict, chapters: list[ChapterMeta], unit_size: int
+    ) -> int:
+        with self._transaction() as db:
+            job_id = db.execute(
+                "INSERT INTO jobs (slug, branch, ranobe_data, created) VALUES (?, ?, ?, ?)",
+                (slug, priority_branch, json.dumps(ranobe_data), time.time()),
+            ).lastrowid
+            units = range((len(chapters) + unit_size - 1) // unit_size)
+            db.executemany("INSERT INTO units (job_id, unit) VALUES (?, ?)", [(job_id, unit) for unit in units])
+            db.executemany(
+                "INSERT INTO chapters (job_id, position, unit, volume, number, meta) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (job_id, i, i // unit_size, str(chapter.volume), str(chapter.number), _dump_meta(chapter))
+                    for i, chapter in enumerate(chapters)
+                ],
+            )
+        return job_id  # type: ignore
+
+    def job(self, job_id: int) -> tuple[str, str, dict]:
+        with self._connect() as db:
+            row = db.execute("SELECT slug, branch, ranobe_data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            raise Exception(f"Задание {job_id} не найдено.")
+        return row[0], row[1], json.loads(row[2])
+
+    def claim(self, worker: str, job_id: int | None = None) -> tuple[int, int] | None:
+        """Берёт в аренду свободный блок (или блок, аренда которого истекла). None - если брать нечего."""
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                """
+                SELECT job_id, unit FROM units
+                WHERE (status = 'pending' OR (status = 'claimed' AND claimed_at < ?))
+                    AND (? IS NULL OR job_id = ?)
+                ORDER BY job_id, unit
+                LIMIT 1
+                """,
+                (now - config.job_lease, job_id, job_id),
+            ).fetchone()
+            if row is None:
+                return None
+
+            db.execute(
+                """
+                UPDATE units SET status = 'claimed', worker = ?, claimed_at = ?, attempts = attempts + 1
+                WHERE job_id = ? AND unit = ?
+                """,
+                (worker, now, *row),
+            )
+        return row
+
+    def renew(self, job_id: int, unit: int, worker: str) -> bool:
+        """Продлевает аренду блока. False - если блок уже у другого рабочего или готов."""
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE units SET claimed_at = ? WHERE job_id = ? AND unit = ? AND worker = ? AND status = 'claimed'",
+                (time.time(), job_id, unit, worker),
+            )
+        return cursor.rowcount == 1
+
+    def unit_chapters(self, job_id: int, unit: int) -> list[tuple[int, ChapterMeta]]:
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT position, meta FROM chapters WHERE job_id = ? AND unit = ? ORDER BY position", (job_id, unit)
+            ).fetchall()
+        return [(position, _load_meta(meta)) for position, meta in rows]
+
+    def chapters(self, job_id: int) -> list[ChapterMeta]:
+        with self._connect() as db:
+            rows = db.execute("SELECT meta FROM chapters WHERE job_id = ? ORDER BY position", (job_id,)).fetchall()
+        return [_load_meta(meta) for (meta,) in rows]
+
+    def finish_unit(
+        self,
+        job_id: int,
+        unit: int,
+        worker: str,
+        chapters: list[tuple[int, bytes | None, str | None]],
+        images: list[tuple[str, StoredFile | None, str | None]],
+    ) -> bool:
+        """Записывает результаты блока: главы (сырые данные или ошибка) и картинки (файл или ошибка).
+
+        Только если блок всё ещё арендован этим рабочим, иначе возвращает False и ничего не пишет.
+        """
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE units SET status = 'done' WHERE job_id = ? AND unit = ? AND worker = ? AND status = 'claimed'",
+                (job_id, unit, worker),
+            )
+            if cursor.rowcount != 1:
+                return False
+
+            db.executemany(
+                "UPDATE chapters SET raw = ?, error = ? WHERE job_id = ? AND position = ?",
+                [(raw, error, job_id, position) for position, raw, error in chapters],
+            )
+            for url, file, error in images:
+                if file is not None:
+                    db.execute("INSERT OR IGNORE INTO blobs (digest, data) VALUES (?, ?)", (file.digest, file.read()))
+                db.execute(
+                    "INSERT OR REPLACE INTO images (job_id, url, digest, error) VALUES (?, ?, ?, ?)",
+                    (job_id, url, file.digest if file else None, error),
+                )
+        return True
+
+    def progress(self, job_id: int) -> dict[str, int]:
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT status, COUNT(*) FROM units WHERE job_id = ? GROUP BY status", (job_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def chapter(self, job_id: int, chapter_meta: ChapterMeta) -> ChapterData:
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT raw, error FROM chapters WHERE job_id = ? AND volume = ? AND number = ?",
+                (job_id, str(chapter_meta.volume), str(chapter_meta.number)),
+            ).fetchone()
+        if row is None or row[0] is None:
+            raise Exception(
+                row[1] if row and row[1] else f"Глава {chapter_meta.volume} - {chapter_meta.number} не скачана."
+            )
+        return ChapterData(number=chapter_meta.number, volume=chapter_meta.volume, raw=row[0])
+
+    def image(self, job_id: int, url: str) -> StoredFile:
+        with self._connect() as db:
+            row = db.execute(
+                """
+                SELECT images.error, blobs.data FROM images LEFT JOIN blobs ON blobs.digest = images.digest
+                WHERE images.job_id = ? AND images.url = ?
+                """,
+                (job_id, url),
+            ).fetchone()
+        if row is None or row[1] is None:
+            raise Exception(row[0] if row and row[0] else f"Картинка {url} не скачана.")
+        return image_store.put(row[1])
+
+
+def create_job(store: JobStore, url: str, priority_branch: str | None = None, start: int = 1, amount: int = 0) -> int:
+    """Получает список глав и создаёт задание. `start` и `amount` - как поля "с главы" и "сколько" в интерфейсе."""
+    slug = slug_from_url(url)
+    ranobe_data, priority_branch, chapters = load_title(slug, priority_branch)
+    return store.create_job(
+        slug, priority_branch, ranobe_data, select_chapters(chapters, start, amount), config.job_unit_size
+    )
+
+
+def _fetch_unit(store: JobStore, job_id: int, unit: int, worker: str, log_func: Callable) -> bool:
+    slug, priority_branch, _ = store.job(job_id)
+    chapters: list[tuple[int, bytes | None, str | None]] = []
+    images: dict[str, tuple[StoredFile | None, str | None]] = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, config.image_workers)) as pool:
+        for position, chapter_meta in store.unit_chapters(job_id, unit):
+            branch = chapter_meta.branch if chapter_meta.branch is not None else priority_branch
+            # Та же пауза между главами, что и при обычном скачивании: рабочих может быть много,
+            # и все они ходят в одно API.
+            time.sleep(config.request_delay)
+            try:
+                chapter = get_chapter(slug, branch, chapter_meta.number, chapter_meta.volume)  # type: ignore
+            except Exception as e:
+                chapters.append((position, None, str(e)))
+                log_func(f"Ошибка: {e}")
+                continue
+            chapters.append((position, chapter.raw, None))
+
+            sources = [(url, extension) for _, url, _, extension in chapter.image_sources if url not in images]
+            for (url, _), download in zip(sources, pool.map(_try_image, sources)):
+                images[url] = download
+            log_func(f"Скачали: Том {chapter_meta.volume}. Глава {chapter_meta.number}. {chapter_meta.name}")
+
+    return store.finish_unit(
+        job_id, unit, worker, chapters, [(url, file, error) for url, (file, error) in images.items()]
+    )
+
+
+@contextmanager
+def _heartbeat(store: JobStore, job_id: int, unit: int, worker: str) -> Iterator[None]:
+    """Продлевает аренду блока каждую треть `config.job_lease`, пока он скачивается."""
+    stop = threading.Event()
+
+    def renew() -> None:
+        while not stop.wait(config.job_lease / 3):
+            try:
+                store.renew(job_id, unit, worker)
+            except sqlite3.Error:
+                # База занята или недоступна: продлим в следующий раз, аренды хватит ещё на две попытки.
+                pass
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _try_image(source: tuple[str, str]) -> tuple[StoredFile | None, str | None]:
+    try:
+        return get_image_content(*source), None
+    except Exception as e:
+        return None, str(e)
+
+
+def run_worker(store: JobStore, job_id: int | None = None, worker: str = "", log_func: Callable = print) -> int:
+    """Забирает и обрабатывает блоки, пока они есть. Возвращает число обработанных блоков."""
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    done = 0
+    while True:
+        reload_profile()
+        if (claimed := store.claim(worker, job_id)) is None:
+            break
+        log_func(f"\n[{worker}] Задание {claimed[0]}, блок {claimed[1]}")
+        with _heartbeat(store, *claimed, worker):
+            finished = _fetch_unit(store, *claimed, worker, log_func=log_func)
+        if finished:
+            done += 1
+        else:
+            log_func(f"[{worker}] Блок {claimed[1]} уже забрал другой рабочий, результаты не записаны.")
+    return done
+
+
+def _stored_handler(handler_cls: type[Handler], store: JobStore, job_id: int) -> type[Handler]:
+    class StoredHandler(handler_cls):  # type: ignore
+        # Повторять недокачанное бессмысленно: хранилище от этого не изменится.
+        deferred_retry_rounds = 0
+
+        def _fetch_chapter(self, slug: str, branch: str, chapter_meta: ChapterMeta) -> ChapterData:
+            return store.chapter(job_id, chapter_meta)
+
+        def _fetch_image(self, url: str, extension: str) -> StoredFile:
+            return store.image(job_id, url)
+
+    return StoredHandler
+
+
+def assemble(
+    store: JobStore,
+    job_id: int,
+    handler_cls: type[Handler],
+    save_dir: str,
+    wait: bool = True,
+    timeout: float | None = None,
+    log_func: Callable = print,
+    **options,
+) -> Handler:
+    """Собирает книгу из скачанных блоков.
+
+    С `wait` сначала дожидается, пока все блоки будут готовы, но не дольше `timeout` секунд
+    (None - `config.job_wait_timeout`).
+    """
+    deadline = time.monotonic() + (config.job_wait_timeout if timeout is None else timeout)
+    while wait and set(progress := store.progress(job_id)) - {"done"}:
+        if time.monotonic() >= deadline:
+            raise Exception(f"Задание {job_id}: не дождались готовности блоков {progress}.")
+        time.sleep(1)
+
+    slug, priority_branch, ranobe_data = store.job(job_id)
+    return build_book(
+        _stored_handler(handler_cls, store, job_id),
+        ranobe_data,
+        slug,
+        priority_branch,
+        store.chapters(job_id),
+        save_dir,
+        log_func=log_func,
+        delay=0,
+        **options,
+    )
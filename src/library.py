@@ -0,0 +1,191 @@
+"""Сборка книг из своего кода, без интерфейса, для asyncio.
+
+    title = await resolve("https://ranobelib.me/ru/book/20818--lord-of-the-mysteries")
+    conversion = Conversion(title, plan(title, start=1, amount=50), "books/lotm.epub")
+    async for chapter in conversion:
+        print(chapter.meta.number, len(chapter.content))
+    failed = await conversion.wait()
+
+Или одной строкой: `failed = await convert(title, plan(title), buffer, format="fb2")`.
+
+Скачивание и сборка идут в отдельном потоке, обработчики прогресса и лога вызываются из него же.
+"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import IO, AsyncIterator, Callable
+
+from src.cancel import CancelToken
+from src.handler import Handler, load_handler
+from src.model import ChapterMeta
+from src.runner import load_title, make_handler, run_handler, select_chapters, slug_from_url
+
+
+@dataclass
+class Title:
+    slug: str
+    data: dict
+    branch: str
+    chapters: list[ChapterMeta]
+
+    @property
+    def name(self) -> str:
+        return self.data.get("rus_name") or self.data.get("name") or self.slug
+
+
+@dataclass
+class RenderedChapter:
+    meta: ChapterMeta
+    # Отрисованная глава в формате книги: XHTML для epub (части через `src.epub.PART_SEPARATOR`), секция для fb2.
+    content: bytes
+    # False - не все картинки скачались. После повторной попытки та же глава может прийти ещё раз.
+    complete: bool
+
+
+async def resolve(url: str, branch: str | None = None) -> Title:
+    """Данные ранобэ, ветка перевода и список глав, распределённых по веткам так же, как в интерфейсе."""
+    slug = slug_from_url(url)
+    data, branch, chapters = await asyncio.to_thread(load_title, slug, branch)
+    return Title(slug=slug, data=data, branch=branch, chapters=chapters)  # type: ignore
+
+
+def plan(title: Title, start: int = 1, amount: int = 0) -> list[ChapterMeta]:
+    """Главы для скачивания: с `start`-й по счёту, `amount` штук (0 - до конца)."""
+    return select_chapters(title.chapters, start, amount)
+
+
+class Conversion:
+    """Одна сборка книги.
+
+    `output` - каталог, путь к файлу или открытый на запись бинарный файл. В файл можно сохранить только
+    книгу без разбивки на части. Сборка запускается первым `async for` или `wait()`.
+    """
+
+    def __init__(
+        self,
+        title: Title,
+        chapters: list[ChapterMeta] | None,
+        output: str | os.PathLike | IO[bytes],
+        format: str = "epub",
+        with_images: bool = True,
+        split_mode: str = "none",
+        split_value: int = 0,
+        delay: float | None = None,
+        progress: Callable[[int, int], None] | None = None,
+        log: Callable[[str], None] | None = None,
+        cancel: CancelToken | None = None,
+    ) -> None:
+        self.title = title
+        self.chapters = chapters if chapters is not None else title.chapters
+        if not self.chapters:
+            raise ValueError("Нет глав для скачивания.")
+        self.output = output
+        self.to_dir = isinstance(output, (str, os.PathLike)) and os.path.isdir(output)
+        if split_mode != "none" and not self.to_dir:
+            raise ValueError("Книгу с разбивкой на части можно сохранить только в каталог.")
+
+        self.format = format
+        self.options = {"with_images": with_images, "split_mode": split_mode, "split_value": split_value}
+        self.delay = delay
+        self.progress = progress
+        self.log = log or (lambda text: None)
+        self.cancel_token = cancel or CancelToken()
+        self.done = 0
+        self.failed: list[str] = []
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Future | None = None
+
+    def cancel(self) -> None:
+        """Остановить скачивание. Уже скачанные главы будут сохранены."""
+        self.cancel_token.cancel()
+
+    def _step(self, step: float) -> None:
+        self.done += int(step)
+        if self.progress is not None:
+            self.progress(self.done, len(self.chapters))
+
+    def _handler(self, save_dir: str, loop: asyncio.AbstractEventLoop) -> Handler:
+        conversion = self
+
+        class LibraryHandler(load_handler(self.format)):  # type: ignore
+            def _on_rendered(self, chapter_meta: ChapterMeta, future: Future, complete: bool) -> None:
+                if conversion._queue is None or future.cancelled() or future.exception() is not None:
+                    return
+                chapter = RenderedChapter(meta=chapter_meta, content=future.result(), complete=complete)
+                loop.call_soon_threadsafe(conversion._queue.put_nowait, chapter)
+
+        handler = make_handler(
+            LibraryHandler, save_dir, log_func=self.log, progress_bar_step=self._step, **self.options
+        )
+        handler.cancel = self.cancel_token
+        return handler
+
+    def _run(self, loop: asyncio.AbstractEventLoop) -> list[str]:
+        save_dir = str(self.output) if self.to_dir else tempfile.mkdtemp(prefix="ranobe2ebook-")
+        try:
+            handler = self._handler(save_dir, loop)
+            run_handler(handler, self.title.data, self.title.slug, self.title.branch, self.chapters, self.delay)
+            self.failed = list(handler.failed)
+            if not self.to_dir:
+                self._deliver(save_dir)
+        finally:
+            if not self.to_dir:
+                shutil.rmtree(save_dir, ignore_errors=True)
+            if self._queue is not None:
+                loop.call_soon_threadsafe(self._queue.put_nowait, None)
+        return self.failed
+
+    def _deliver(self, save_dir: str) -> None:
+        files = os.listdir(save_dir)
+        if not files:
+            # Скачивание остановили раньше, чем появилась хоть одна глава.
+            return
+
+        path = os.path.join(save_dir, files[0])
+        if isinstance(self.output, (str, os.PathLike)):
+            shutil.move(path, self.output)
+        else:
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, self.output)
+
+    def _start(self, stream: bool) -> asyncio.Future:
+        if self._task is None:
+            loop = asyncio.get_running_loop()
+            if stream:
+                self._queue = asyncio.Queue()
+            self._task = loop.run_in_executor(None, self._run, loop)
+        return self._task
+
+    async def __aiter__(self) -> AsyncIterator[RenderedChapter]:
+        if self._task is not None and self._queue is None:
+            raise RuntimeError("Сборка уже запущена без потоковой выдачи глав.")
+        task = self._start(stream=True)
+        try:
+            while (chapter := await self._queue.get()) is not None:  # type: ignore
+                yield chapter
+            await task
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+
+    async def wait(self) -> list[str]:
+        """Дожидается конца сборки и сохранения. Возвращает список недокачанных глав.
+
+        Отмена ожидания (`task.cancel()`) останавливает и саму сборку.
+        """
+        try:
+            return await asyncio.shield(self._start(stream=False))
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+
+
+async def convert(
+    title: Title, chapters: list[ChapterMeta] | None, output: str | os.PathLike | IO[bytes], **options
+) -> list[str]:
+    """Собирает книгу целиком, см. `Conversion`. Возвращает список недокачанных глав."""
+    return await Conversion(title, chapters, output, **options).wait()
@@ -5,7 +5,6 @@ from urllib.parse import urlparse
 
 import traceback
 
-import pyperclip
 from textual import on, work
 from textual.app import App, ComposeResult
 from textual.validation import Function
@@ -27,12 +26,15 @@ from textual.widgets import (
     Switch,
 )
 
-from textual_fspicker import SelectDirectory
 
 from src.config import config, VERSION
-from src.model import ChapterMeta, Handler, State
+from src.events import EventBus
+from src.handler import Handler, load_handler
+from src.model import ChapterMeta, State
+from src.profile import reload_profile
 from src.api import get_branchs, get_chapters_data, get_latest_release, get_ranobe_data
-from src.utils import is_jwt, is_valid_url
+from src.session import restore_token, save_session
+from src.utils import is_jwt, is_valid_url, plan_branches
 
 title = r"""
      ____                   _          _     ___ ____    ____         _                 _    
@@ -58,6 +60,8 @@ class Ranobe2ebook(App):
     ranobe_data: dict
     chapters_data: list[ChapterMeta]
     priority_branch: str
+    branch_names: dict[str, str] = {}
+    branch_order: list[str] = []
     dir: str = os.path.normpath(os.path.expanduser("~/Desktop"))
     start: int
     amount: int
@@ -70,10 +74,11 @@ class Ranobe2ebook(App):
     def __init__(
         self,
         *,
-        handlers: dict[str, Handler],
+        handlers: dict[str, str],
     ) -> None:
         super().__init__()
         self.handlers = handlers
+        self.events = EventBus(max_lines=config.ui_queue_lines)
 
     BINDINGS = [
         Binding(key="ctrl+q", action="quit", key_display="ctrl + q", description="Выйти"),
@@ -155,6 +160,22 @@ class Ranobe2ebook(App):
                             yield Rule(line_style="heavy", classes="rule")
                             yield RadioButton("EPUB", name="epub", value=True)
                             yield RadioButton("FB2", name="fb2")
+                            yield RadioButton("FB2.ZIP", name="fb2.zip")
+
+                        with RadioSet(id="split", name="split", classes="w-full mb-1"):
+                            yield Label("Разделить книгу")
+                            yield Rule(line_style="heavy", classes="rule")
+                            yield RadioButton("Одним файлом", name="none", value=True)
+                            yield RadioButton("По томам", name="volume")
+                            yield RadioButton("По N глав", name="chapters")
+                            yield RadioButton("По размеру, МБ", name="size")
+                            yield Input(
+                                placeholder="N",
+                                id="input_split",
+                                type="integer",
+                                disabled=True,
+                                classes="input",
+                            )
 
                         with RadioSet(id="save_dir", classes="w-full mb-1"):
                             yield Label("Сохранить в папку")
@@ -188,9 +209,28 @@ class Ranobe2ebook(App):
                             )
                         yield Label("", id="chapters_count", classes="w-full m1-2")
 
-                        yield Log(id="log", classes="w-frame")
+                        yield Log(id="log", max_lines=config.ui_log_lines, classes="w-frame")
                         yield Log(id="chapter_list", auto_scroll=False, classes="w-frame")
 
+    def on_mount(self) -> None:
+        self.set_interval(1 / config.ui_fps, self.drain_events)
+
+        if not config.token and (token := restore_token()):
+            config.token = token
+            button: Button = self.query_one("#paste_token")  # type: ignore
+            button.variant = "success"
+            button.label = "🔓"
+
+    def drain_events(self) -> None:
+        """Переносит накопленные обработчиками события в интерфейс одним обновлением."""
+        lines, dropped, progress = self.events.drain()
+        if dropped:
+            lines.insert(0, f"... пропущено строк лога: {dropped}")
+        if lines:
+            self.query_one("#log").write_lines(lines)  # type: ignore
+        if progress:
+            self.query_one("#download_progress").advance(progress)  # type: ignore
+
     def action_open_issue_link(self) -> None:
         webbrowser.open("https://github.com/DustGalaxy/RanobeLib2ebook/issues")
 
@@ -296,13 +336,16 @@ class Ranobe2ebook(App):
             log.write_line("Получили список ветвей перевода.")
 
         options: list[tuple[str, str]] = []
-        for i, branch in enumerate(branchs):  # type: ignore
+        self.branch_names = {}
+        for i, branch in enumerate(branchs or []):  # type: ignore
             options.append(
                 (
                     f"{branch.get('name')}. Переводчики: {' & '.join([team.get('name') for team in branch.get('teams')])}",
                     str(branch.get("id")),
                 )
             )
+            self.branch_names[str(branch.get("id"))] = branch.get("name")
+        self.branch_order = [option[1] for option in options]
 
         if len(options) == 0:
             options = [("Main branch", "0")]
@@ -324,17 +367,6 @@ class Ranobe2ebook(App):
         self.query_one("#input_start").value = "1"  # type: ignore
         self.query_one("#input_end").value = str(len(self.chapters_data))  # type: ignore
 
-        total_len = len(str(len(self.chapters_data)))
-        chap_len = len(str(max(self.chapters_data, key=lambda x: len(str(x.number))).number))
-        volume_len = len(str(self.chapters_data[-1].volume))
-
-        self.query_one("#chapter_list").write_lines(  # pyright: ignore[reportAttributeAccessIssue]
-            [
-                f"{i:>{total_len}}: Том {chapter.volume:>{volume_len}}. Глава {chapter.number:>{chap_len}}. {chapter.name}"
-                for i, chapter in enumerate(self.chapters_data, 1)
-            ]
-        )
-
         log.write_line("\nГотовы к скачиванию!")
 
         self.state.is_chapters_selected = True
@@ -347,13 +379,44 @@ class Ranobe2ebook(App):
         self.query_one("#input_start").disabled = False
         self.query_one("#input_end").disabled = False
 
+    def show_plan(self) -> None:
+        """Распределяет главы по веткам перевода и показывает план загрузки."""
+        log: Log = self.query_one("#log")  # type: ignore
+        chapter_list: Log = self.query_one("#chapter_list")  # type: ignore
+
+        plan = plan_branches(self.chapters_data, self.priority_branch, self.branch_order)
+
+        log.write_line("\nПлан загрузки по веткам перевода:")
+        for branch, count in plan.items():
+            log.write_line(f"{self.branch_names.get(branch, 'Ветка по умолчанию')}: {count} глав")
+
+        total_len = len(str(len(self.chapters_data)))
+        chap_len = len(str(max(self.chapters_data, key=lambda x: len(str(x.number))).number))
+        volume_len = len(str(self.chapters_data[-1].volume))
+
+        chapter_list.clear()
+        chapter_list.write_lines(
+            [
+                f"{i:>{total_len}}: Том {chapter.volume:>{volume_len}}. Глава {chapter.number:>{chap_len}}. {chapter.name}"
+                + (
+                    f" [{self.branch_names.get(chapter.branch, 'ветка по умолчанию')}]"  # type: ignore
+                    if chapter.branch != self.priority_branch
+                    else ""
+                )
+                for i, chapter in enumerate(self.chapters_data, 1)
+            ]
+        )
+
     @on(Button.Pressed, "#paste_token")
     def paste_token(self, event: Button.Pressed) -> None:
+        import pyperclip
+
         token = pyperclip.paste()
         if not is_jwt(token):
             self.notify("Некоректный токен", severity="error", timeout=2)
             return
         config.token = token
+        save_session()
         event.button.variant = "success"  # success("🔓")
         event.button.label = "🔓"
         self.notify("Токен скопирован", timeout=2)
@@ -365,6 +428,8 @@ class Ranobe2ebook(App):
 
     @on(Button.Pressed, "#paste_link")
     def paste_link(self, event: Button.Pressed) -> None:
+        import pyperclip
+
         clipboard_content = pyperclip.paste()
         if is_valid_url(clipboard_content):
             self.query_one("#input_link").value = clipboard_content  # type: ignore
@@ -374,26 +439,27 @@ class Ranobe2ebook(App):
 
     @work(name="make_ebook_worker", exclusive=True, thread=True)
     async def make_ebook_worker(self) -> None:
-        log: Log = self.query_one("#log")  # type: ignore
-        p_bar: ProgressBar = self.query_one("#download_progress")  # type: ignore
-
+        if reload_profile():
+            self.events.log("Профиль перечитан")
         format = self.query_one("#format").pressed_button.name  # type: ignore
         add_images = self.query_one("#add_images").value  # type: ignore
 
-        Handler_: Handler = self.handlers[format]
+        Handler_: type[Handler] = load_handler(format, self.handlers)
 
-        self.ebook = Handler_(log_func=log.write_line, progress_bar_step=p_bar.advance)  # type: ignore
+        self.ebook = Handler_(log_func=self.events.log, progress_bar_step=self.events.advance)  # type: ignore
         self.ebook.with_images = add_images
+        self.ebook.split_mode = self.query_one("#split").pressed_button.name  # type: ignore
+        split_value = self.query_one("#input_split").value  # type: ignore
+        self.ebook.split_value = int(split_value) if split_value.isdigit() else 0
+        self.ebook.save_dir = self.dir
         try:
             self.ebook.make_book(self.ranobe_data)
-            log.write_line("Создали книгу")
+            self.events.log("Создали книгу")
         except Exception as e:
-            log.write_line(str(e))
+            self.events.log(str(e))
 
     @work(name="fill_ebook_worker", exclusive=True, thread=True)
     async def fill_ebook_worker(self) -> None:
-        log: Log = self.query_one("#log")  # type: ignore
-        self.query_one("#stop_and_save").disabled = False
         try:
             worker = get_current_worker()
             self.ebook.fill_book(
@@ -401,31 +467,29 @@ class Ranobe2ebook(App):
             )
 
         except Exception as e:
-            log.write_line("".join(traceback.format_exception(type(e), e, e.__traceback__)))
+            self.events.log("".join(traceback.format_exception(type(e), e, e.__traceback__)))
 
     @work(name="end_ebook_worker", exclusive=True, thread=True)
     async def end_ebook_worker(self) -> None:
-        log: Log = self.query_one("#log")  # type: ignore
-        self.query_one("#stop_and_save").disabled = True
         try:
-            self.ebook.end_book()
+            if self.ebook.book is not None:
+                self.ebook.end_book()
 
         except Exception as e:
-            log.write_line(str(e))
+            self.events.log(str(e))
 
     @work(name="save_ebook_worker", exclusive=True, thread=True)
     async def save_ebook_worker(self) -> None:
-        log: Log = self.query_one("#log")  # type: ignore
-
         try:
-            log.write_line("\nСохраняем книгу...")
+            self.events.log("\nСохраняем книгу...")
             self.ebook.save_book(self.dir)
         except Exception as e:
-            log.write_line(str(e))
-        self.query_one("#check_link").disabled = False
+            self.events.log(str(e))
+        save_session()
 
     @on(Worker.StateChanged)
     def worker_manage(self, event: Worker.StateChanged) -> None:
+        # Виджеты меняем только здесь, в потоке приложения, а не из рабочих потоков.
         match event.worker.name:
             case "make_ebook_worker":
                 match event.state.name:
@@ -433,12 +497,19 @@ class Ranobe2ebook(App):
                         self.fill_ebook_worker()
             case "fill_ebook_worker":
                 match event.state.name:
+                    case "RUNNING":
+                        self.query_one("#stop_and_save").disabled = False
                     case "SUCCESS" | "CANCELLED" | "ERROR":
+                        self.query_one("#stop_and_save").disabled = True
                         self.end_ebook_worker()
             case "end_ebook_worker":
                 match event.state.name:
                     case "SUCCESS":
                         self.save_ebook_worker()
+            case "save_ebook_worker":
+                match event.state.name:
+                    case "SUCCESS" | "CANCELLED" | "ERROR":
+                        self.query_one("#check_link").disabled = False
 
     @on(Button.Pressed, "#download")
     def download(self, event: Button.Pressed) -> None:
@@ -455,18 +526,27 @@ class Ranobe2ebook(App):
 
     @on(Button.Pressed, "#stop_and_save")
     def stop_and_save(self, event: Button.Pressed) -> None:
-        self.end_ebook_worker()
+        # Только сигналим: fill_book сам быстро выйдет и доведёт книгу до целого состояния,
+        # а дальше она завершится и сохранится обычным путём через worker_manage.
+        event.button.disabled = True
+        self.events.log("\nОстанавливаем скачивание...")
+        self.ebook.cancel.cancel()
 
     @on(Select.Changed, "#branch_list")
     def branch_list(self, event: Select.Changed) -> None:
         if event.select.value != Select.BLANK:
             self.state.is_branch_selected = True
             self.priority_branch = event.select.value  # type: ignore
+            if self.state.is_data_loaded and self.chapters_data:
+                self.show_plan()
             self.dev_print(event.select.value)  # type: ignore
 
     @on(RadioSet.Changed)
     def set_option(self, event: RadioSet.Changed) -> None:
         match event.radio_set.id:
+            case "split":
+                input_split: Input = self.query_one("#input_split")  # type: ignore
+                input_split.disabled = event.radio_set.pressed_button.name not in ("chapters", "size")  # type: ignore
             case "save_dir":
                 self.dev_print(event.radio_set.pressed_button.label)  # type: ignore
                 input_save_dir: Input = self.query_one("#input_save_dir")  # type: ignore
@@ -489,6 +569,8 @@ class Ranobe2ebook(App):
                         self.dir = None  # type: ignore
                         input_save_dir.disabled = False
 
+                        from textual_fspicker import SelectDirectory
+
                         self.push_screen(
                             SelectDirectory(
                                 location=input_save_dir.value if input_save_dir.value else ".",
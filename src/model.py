@@ -1,7 +1,7 @@
-from abc import ABC, abstractmethod
+import mmap
 from dataclasses import dataclass, field
-from typing import Any, Callable, Literal
-from xml.etree import ElementTree as ET
+from functools import cached_property
+from typing import Iterator, Literal
 
 
 @dataclass
@@ -12,11 +12,30 @@ class State:
     is_dir_selected: bool = False
 
 
+@dataclass
+class StoredFile:
+    path: str
+    digest: str
+    size: int
+
+    def read(self) -> bytes:
+        return b"".join(self.iter_chunks())
+
+    def iter_chunks(self, chunk_size: int = 3 * 64 * 1024) -> Iterator[bytes]:
+        """Читает файл через mmap кусками, не держа его целиком в памяти."""
+        if not self.size:
+            return
+
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for start in range(0, len(mapped), chunk_size):
+                yield mapped[start : start + chunk_size]
+
+
 @dataclass
 class Image:
     uid: str
     extension: str
-    content: bytes
+    file: StoredFile
     static_url: str = ""
     media_type: str = ""
 
@@ -24,12 +43,18 @@ class Image:
         self.static_url = f"static/{self.uid}"
         self.media_type = f"image/{self.extension}"
 
+    @property
+    def content(self) -> bytes:
+        return self.file.read()
+
 
 @dataclass
 class ChapterMeta:
     name: str
     number: int
     volume: int
+    branches: list[str] = field(default_factory=list)
+    branch: str | None = None
 
 
 @dataclass
@@ -45,53 +70,142 @@ class Attachment:
 
 @dataclass
 class ChapterData:
-    id: str
-    number: int
-    volume: int
-    type: Literal["doc", "html"]
-    content: list[dict]
-    attachments: list[Attachment] = field(default_factory=list)
+    """Глава в том виде, в котором её отдало API.
 
+    Тело ответа хранится сырыми байтами и разбирается только при первом обращении
+    к `id`, `type`, `content` или `attachments`, так что пропущенные главы не платят за разбор.
+    """
 
-@dataclass
-class Exception:
-    message: str
+    number: int
+    volume: int
+    raw: bytes = field(default=b"", repr=False)
+
+    def __getstate__(self) -> dict:
+        # В процессы отрисовки уходят только сырые байты, без уже разобранного дерева.
+        return {"number": self.number, "volume": self.volume, "raw": self.raw}
+
+    @cached_property
+    def data(self) -> dict:
+        from src.utils import json_loads
+
+        return json_loads(self.raw).get("data")
+
+    @cached_property
+    def id(self) -> str:
+        return self.data.get("id")
+
+    @cached_property
+    def type(self) -> Literal["doc", "html"]:
+        from src.utils import is_html
+
+        content = self.data.get("content")
+        return "html" if isinstance(content, str) and is_html(content) else "doc"
+
+    @cached_property
+    def content(self) -> list[dict] | str:
+        content = self.data.get("content")
+        return content if self.type == "html" else content.get("content")
+
+    @cached_property
+    def attachments(self) -> list[Attachment]:
+        return [
+            Attachment(
+                id=item.get("id"),
+                name=item.get("name"),
+                url=item.get("url"),
+                extension=item.get("extension"),
+                filename=item.get("filename"),
+                width=item.get("width"),
+                height=item.get("height"),
+            )
+            for item in self.data.get("attachments") or []
+        ]
+
+    @cached_property
+    def image_sources(self) -> list[tuple[str, str, str, str]]:
+        """Картинки главы: ключ, по которому их ищет отрисовка, ссылка, имя файла и расширение."""
+        from src.config import config
+        from src.utils import find_img_sources
+
+        if self.type == "html":
+            return [(url, url, url.split("/")[-1], url.split(".")[-1]) for url in find_img_sources(self.content)]
+
+        return [
+            (attachment.name, config.site_url + attachment.url, attachment.filename, attachment.extension)
+            for attachment in self.attachments
+        ]
 
 
 @dataclass
-class Config:
-    token: str = ""
-
+class RenderTask:
+    """Всё, что нужно для отрисовки главы в другом процессе.
 
-class Handler(ABC):
-    log_func: Callable
-    progress_bar_step: Callable
-
-    min_chapter: str
-    max_chapter: str
+    Сырые данные, заголовок и ссылки на уже добавленные в книгу картинки.
+    """
 
+    chapter: ChapterData
+    title: str
+    images: dict[str, str]
     with_images: bool
+    split_size: int = 0
 
-    style_tags: dict[str, str] = field(default_factory=dict)
-
-    def __init__(self, log_func: Callable, progress_bar_step: Callable) -> None:
-        self.log_func = log_func
-        self.progress_bar_step = progress_bar_step
-
-    @abstractmethod
-    def fill_book(
-        self, slug: str, priority_branch: str, chapters_data: list[ChapterMeta], worker, delay: float = 0.5
-    ) -> None:
-        pass
 
-    @abstractmethod
-    def make_book(self, ranobe_data: dict) -> None:
-        pass
+@dataclass
+class Exception:
+    message: str
 
-    @abstractmethod
-    def end_book(self) -> None:
-        pass
 
-    @abstractmethod
-    def save_book(self, dir: str) -> None:
-        pass
+@dataclass
+class Config:
+    token: str = ""
+    data_dir: str = ""
+    logs_dir: str = ""
+    api_url: str = ""
+    site_url: str = "https://ranobelib.me"
+    save_workers: int = 2
+    connect_timeout: float = 5.0
+    read_timeout: float = 30.0
+    retries: int = 3
+    backoff_base: float = 1.0
+    backoff_max: float = 30.0
+    request_delay: float = 0.5
+    # Запросов в секунду к отдельным хостам, например {"api.example.org": 3.0}. Хосты не из списка не ограничены.
+    host_rates: dict[str, float] = field(default_factory=dict)
+    deferred_retry_rounds: int = 2
+    deferred_retry_delay: float = 10.0
+    image_max_size: int = 20 * 1024 * 1024
+    image_workers: int = 6
+    image_quality: int = 70
+    hedge_percentile: float = 0.0
+    hedge_budget: float = 0.05
+    hedge_min_samples: int = 20
+    hedge_min_delay: float = 1.0
+    render_workers: int = 0
+    chapter_split_size: int = 256 * 1024
+    toc_mode: Literal["volumes", "compact"] = "volumes"
+    cancel_drain_timeout: float = 2.0
+    job_unit_size: int = 10
+    job_lease: float = 300.0
+    # Сколько `jobs assemble` ждёт готовности всех блоков, если рабочие остановились или не запущены.
+    job_wait_timeout: float = 24 * 3600.0
+    service_host: str = "127.0.0.1"
+    service_port: int = 8700
+    service_dir: str = ""
+    service_jobs: int = 2
+    service_metadata_ttl: float = 600.0
+    # Завершённые задания сервиса и их файлы удаляются через столько секунд,
+    # и хранится их не больше `service_keep_jobs`.
+    service_job_ttl: float = 24 * 3600.0
+    service_keep_jobs: int = 100
+    cache_enabled: bool = False
+    cache_dir: str = ""
+    cache_max_size: int = 1024 * 1024 * 1024
+    prefetch_interval: float = 3600.0
+    prefetch_window: str = ""
+    prefetch_delay: float = 1.0
+    ui_fps: int = 10
+    ui_log_lines: int = 5000
+    ui_queue_lines: int = 1000
+    save_profile: Literal["normal", "fast"] = "normal"
+    compress_level: int = 6
+    compress_workers: int = 0
@@ -0,0 +1,196 @@
+"""Профиль производительности: TOML-файл с настройками из `Config`.
+
+Таблицы в файле нужны только для группировки, ключи внутри - имена полей `Config`:
+
+    [network]
+    connect_timeout = 5
+    read_timeout = 20
+    retries = 5
+    request_delay = 0.3
+    host_rates = { "api.example.org" = 3.0 }
+
+    [workers]
+    image_workers = 8
+    render_workers = 4
+
+    [cache]
+    cache_enabled = true
+    cache_max_size = 2_000_000_000
+
+    [images]
+    image_quality = 60
+
+Профиль выбирается параметром `--profile` (`python -m src.cli --profile fast.toml ...`) или переменной окружения
+RANOBE2EBOOK_PROFILE. Незаданные поля остаются по умолчанию. Неизвестные ключи и неподходящие значения - ошибка.
+`reload_profile` перечитывает файл, если он изменился; сервис, рабочие и подкачка вызывают её перед каждым заданием.
+"""
+
+import logging
+import os
+import tomllib
+from dataclasses import fields
+from datetime import datetime
+from typing import Any, Literal, get_args, get_origin, get_type_hints
+
+from src.config import config
+from src.model import Config
+
+logger = logging.getLogger(__name__)
+
+ENV_VAR = "RANOBE2EBOOK_PROFILE"
+
+# Поля, которые не имеют смысла в общем файле профиля.
+PRIVATE_FIELDS = {"token"}
+
+# Допустимые границы числовых полей, включительно. None - без ограничения.
+LIMITS: dict[str, tuple[float | None, float | None]] = {
+    "save_workers": (1, None),
+    "connect_timeout": (0.1, None),
+    "read_timeout": (0.1, None),
+    "retries": (0, 20),
+    "backoff_base": (0, None),
+    "backoff_max": (0, None),
+    "deferred_retry_rounds": (0, None),
+    "deferred_retry_delay": (0, None),
+    "request_delay": (0, None),
+    "image_max_size": (1, None),
+    "image_workers": (1, 64),
+    "image_quality": (1, 100),
+    "hedge_percentile": (0, 1),
+    "hedge_budget": (0, 1),
+    "hedge_min_samples": (1, None),
+    "hedge_min_delay": (0, None),
+    "render_workers": (0, None),
+    "chapter_split_size": (0, None),
+    "cancel_drain_timeout": (0, None),
+    "job_unit_size": (1, None),
+    "job_lease": (1, None),
+    "job_wait_timeout": (0, None),
+    "service_port": (1, 65535),
+    "service_jobs": (1, None),
+    "service_metadata_ttl": (0, None),
+    "service_job_ttl": (1, None),
+    "service_keep_jobs": (1, None),
+    "cache_max_size": (0, None),
+    "prefetch_interval": (1, None),
+    "prefetch_delay": (0, None),
+    "ui_fps": (1, 120),
+    "ui_log_lines": (1, None),
+    "ui_queue_lines": (1, None),
+    "compress_level": (0, 9),
+    "compress_workers": (0, None),
+}
+
+
+class ProfileError(Exception):
+    pass
+
+
+def _check_type(name: str, value: Any, hint: Any) -> Any:
+    origin = get_origin(hint)
+    if origin is Literal:
+        if value not in get_args(hint):
+            raise ProfileError(f"{name}: допустимые значения - {', '.join(map(str, get_args(hint)))}.")
+        return value
+    if origin is dict:
+        if not isinstance(value, dict) or not all(
+            isinstance(v, (int, float)) and not isinstance(v, bool) and v > 0 for v in value.values()
+        ):
+            raise ProfileError(f"{name}: нужна таблица вида {{ хост = число > 0 }}.")
+        return {str(k): float(v) for k, v in value.items()}
+    if hint is float and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if hint is int and isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if hint in (str, bool) and isinstance(value, hint):
+        return value
+    raise ProfileError(f"{name}: ожидается {hint.__name__}, получено {type(value).__name__}.")
+
+
+def parse_profile(data: dict) -> dict[str, Any]:
+    """Проверяет содержимое профиля и возвращает плоский словарь `поле -> значение`."""
+    hints = get_type_hints(Config)
+    allowed = {f.name for f in fields(Config)} - PRIVATE_FIELDS
+    flat: dict[str, Any] = {}
+
+    for key, value in data.items():
+        # Таблица, которая не является полем Config, - это группа полей.
+        items = value.items() if isinstance(value, dict) and key not in allowed else [(key, value)]
+        for name, item in items:
+            if name not in allowed:
+                raise ProfileError(f"Неизвестный параметр {name}.")
+            if name in flat:
+                raise ProfileError(f"Параметр {name} задан дважды.")
+            flat[name] = _check_type(name, item, hints[name])
+
+    for name, (low, high) in LIMITS.items():
+        if name in flat and ((low is not None and flat[name] < low) or (high is not None and flat[name] > high)):
+            raise ProfileError(f"{name}: значение должно быть в пределах {low}..{'' if high is None else high}.")
+
+    if flat.get("prefetch_window"):
+        try:
+            start, end = flat["prefetch_window"].split("-")
+            datetime.strptime(start.strip(), "%H:%M")
+            datetime.strptime(end.strip(), "%H:%M")
+        except ValueError:
+            raise ProfileError('prefetch_window: нужен формат "ЧЧ:ММ-ЧЧ:ММ".')
+
+    return flat
+
+
+class Profile:
+    """Загруженный профиль: путь, время изменения файла и заданные в нём поля."""
+
+    def __init__(self) -> None:
+        self.path = ""
+        self.mtime = 0.0
+        self.values: dict[str, Any] = {}
+
+    def load(self, path: str) -> None:
+        try:
+            with open(path, "rb") as f:
+                data = tomllib.load(f)
+        except OSError as e:
+            raise ProfileError(f"Не удалось прочитать профиль {path}: {e}")
+        except tomllib.TOMLDecodeError as e:
+            raise ProfileError(f"Ошибка в профиле {path}: {e}")
+        values = parse_profile(data)
+
+        # Поля, которые убрали из файла, возвращаются к значениям по умолчанию,
+        # а то, что не задавалось профилем (например, параметры командной строки), не трогаем.
+        defaults = Config()
+        for name in self.values.keys() - values.keys():
+            setattr(config, name, getattr(defaults, name))
+        for name, value in values.items():
+            setattr(config, name, value)
+
+        self.path, self.mtime, self.values = path, os.path.getmtime(path), values
+
+    def reload(self) -> bool:
+        """Перечитывает профиль, если файл изменился. При ошибке в файле остаются прежние настройки."""
+        if not self.path:
+            return False
+        try:
+            if os.path.getmtime(self.path) == self.mtime:
+                return False
+            self.load(self.path)
+        except (OSError, ProfileError) as e:
+            logger.warning("Профиль не перечитан: %s", e)
+            return False
+        return True
+
+
+profile = Profile()
+
+
+def load_profile(path: str | None = None) -> bool:
+    """Загружает профиль из `path` или из RANOBE2EBOOK_PROFILE. Возвращает False, если профиль не задан."""
+    path = path or os.environ.get(ENV_VAR, "")
+    if not path:
+        return False
+    profile.load(path)
+    return True
+
+
+def reload_profile() -> bool:
+    return profile.reload()
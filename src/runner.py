@@ -0,0 +1,92 @@
+"""Скачивание книги без интерфейса: то же, что делают рабочие потоки `src.menu`, но обычными функциями."""
+
+import os
+from typing import Callable
+from urllib.parse import urlparse
+
+from src.api import get_branchs, get_chapters_data, get_ranobe_data
+from src.handler import Handler
+from src.model import ChapterMeta
+from src.utils import plan_branches
+
+
+def slug_from_url(url: str) -> str:
+    """Принимает ссылку на ранобэ или уже готовый slug."""
+    return urlparse(url).path.rstrip("/").split("/")[-1] if "/" in url else url
+
+
+def load_title(slug: str, priority_branch: str | None = None) -> tuple[dict, str, list[ChapterMeta]]:
+    """Получает данные ранобэ, выбирает ветку перевода и распределяет главы по веткам, как в интерфейсе.
+
+    Без `priority_branch` берётся первая ветка из API (или "0", если веток нет).
+    """
+    ranobe_data = get_ranobe_data(slug)
+    if ranobe_data is None:
+        raise Exception(f"Не удалось получить данные ранобэ {slug}.")
+
+    branchs = get_branchs(ranobe_data.get("id")) or []  # type: ignore
+    branch_order = [str(branch.get("id")) for branch in branchs]
+    if priority_branch is None:
+        priority_branch = branch_order[0] if branch_order else "0"
+
+    chapters = get_chapters_data(slug)
+    if chapters is None:
+        raise Exception(f"Не удалось получить список глав ранобэ {slug}.")
+
+    plan_branches(chapters, priority_branch, branch_order)
+    return ranobe_data, priority_branch, chapters
+
+
+def select_chapters(chapters: list[ChapterMeta], start: int = 1, amount: int = 0) -> list[ChapterMeta]:
+    """Как поля "с главы" и "сколько" в интерфейсе: `amount` 0 - до конца."""
+    return chapters[start - 1 : start - 1 + amount] if amount else chapters[start - 1 :]
+
+
+def make_handler(
+    handler_cls: type[Handler],
+    save_dir: str,
+    log_func: Callable = print,
+    progress_bar_step: Callable = lambda step: None,
+    with_images: bool = True,
+    split_mode: str = "none",
+    split_value: int = 0,
+) -> Handler:
+    handler = handler_cls(log_func=log_func, progress_bar_step=progress_bar_step)
+    handler.with_images = with_images
+    handler.split_mode = split_mode  # type: ignore
+    handler.split_value = split_value
+    handler.save_dir = save_dir
+    return handler
+
+
+def run_handler(
+    handler: Handler,
+    ranobe_data: dict,
+    slug: str,
+    priority_branch: str,
+    chapters: list[ChapterMeta],
+    delay: float | None = None,
+) -> Handler:
+    """Собирает и сохраняет книгу уже настроенным обработчиком. Возвращает его, чтобы можно было посмотреть `failed`."""
+    os.makedirs(handler.save_dir, exist_ok=True)
+    handler.make_book(ranobe_data)
+    handler.fill_book(slug, priority_branch, chapters, delay=delay)
+    if handler.book is not None:
+        handler.end_book()
+    handler.save_book(handler.save_dir)
+    return handler
+
+
+def build_book(
+    handler_cls: type[Handler],
+    ranobe_data: dict,
+    slug: str,
+    priority_branch: str,
+    chapters: list[ChapterMeta],
+    save_dir: str,
+    delay: float | None = None,
+    **options,
+) -> Handler:
+    """`make_handler` и `run_handler` за один вызов."""
+    handler = make_handler(handler_cls, save_dir, **options)
+    return run_handler(handler, ranobe_data, slug, priority_branch, chapters, delay=delay)
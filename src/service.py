@@ -0,0 +1,390 @@
+"""Долгоживущий локальный сервис сборки книг.
+
+Принимает задания по HTTP (на localhost или через Unix-сокет) и выполняет их в одном процессе,
+поэтому соединения, допуск Cloudflare, адрес API, данные ранобэ и скачанные картинки переиспользуются
+между сборками, а процессы отрисовки запускаются один раз.
+
+    POST /jobs                      {"url": "...", "branch": "...", "start": 1, "amount": 0, "format": "epub",
+                                     "with_images": true, "split_mode": "none", "split_value": 0,
+                                     "delay": 0.5}
+    GET  /jobs                      список заданий
+    GET  /jobs/<id>                 состояние, прогресс, последние строки лога, готовые файлы
+    GET  /jobs/<id>/files/<имя>     скачать готовый файл
+    POST /jobs/<id>/cancel          остановить и сохранить скачанное
+
+Завершённые задания вместе с файлами удаляются через `config.service_job_ttl` секунд, а если их больше
+`config.service_keep_jobs`, то сначала самые старые.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import socketserver
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable
+
+from src.config import config
+from src.handler import HANDLERS, Handler, load_handler
+from src.model import ChapterMeta, StoredFile
+from src.profile import reload_profile
+from src.runner import load_title, make_handler, run_handler, select_chapters, slug_from_url
+from src.session import restore_token, save_session
+
+logger = logging.getLogger(__name__)
+
+SPLIT_MODES = ("none", "volume", "chapters", "size")
+# Наименьшие допустимые значения числовых полей задания.
+MINIMUMS = {"start": 1, "amount": 0, "split_value": 0}
+# Как часто проверять, не пора ли удалить старые задания.
+EVICT_INTERVAL = 60.0
+
+
+@dataclass
+class ServiceJob:
+    id: str
+    options: dict
+    dir: Path
+    status: str = "queued"
+    error: str = ""
+    created: float = field(default_factory=time.time)
+    finished: float | None = None
+    total: int = 0
+    done: float = 0
+    log: deque = field(default_factory=lambda: deque(maxlen=config.ui_log_lines))
+    failed: list[str] = field(default_factory=list)
+    handler: Handler | None = None
+    future: Future | None = None
+
+    def summary(self, lines: int = 0) -> dict:
+        result: dict[str, Any] = {
+            "id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+            "progress": {"done": int(self.done), "total": self.total},
+            "failed": self.failed,
+            "files": self.files(),
+        }
+        if lines:
+            result["log"] = list(self.log)[-lines:]
+        return result
+
+    def files(self) -> list[str]:
+        return sorted(path.name for path in self.dir.iterdir() if path.is_file()) if self.dir.exists() else []
+
+
+class BuildService:
+    """Очередь сборок и всё, что между ними стоит держать прогретым."""
+
+    def __init__(self, dir: str | None = None) -> None:
+        self.dir = Path(dir or config.service_dir or Path(config.data_dir or Path.home() / ".ranobe2ebook") / "books")
+        self.jobs: dict[str, ServiceJob] = {}
+        self._lock = threading.Lock()
+        self._titles: dict[tuple[str, str | None], tuple[float, tuple[dict, str, list[ChapterMeta]]]] = {}
+        self._titles_lock = threading.Lock()
+        # Ключ картинки -> (когда последний раз понадобилась, файл в `image_store`).
+        self._images: dict[str, tuple[float, StoredFile]] = {}
+        self._images_lock = threading.Lock()
+        self.builds = ThreadPoolExecutor(max_workers=max(1, config.service_jobs), thread_name_prefix="build")
+        workers = config.render_workers or os.cpu_count() or 1
+        self.render_pool = (
+            ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            if workers > 1
+            else None
+        )
+        self._closed = threading.Event()
+        threading.Thread(target=self._evict_loop, name="evict", daemon=True).start()
+
+    def submit(self, options: dict) -> ServiceJob:
+        options = self._validate(options)
+        self.evict()
+        job_id = uuid.uuid4().hex[:12]
+        job = ServiceJob(id=job_id, options=options, dir=self.dir / job_id)
+        with self._lock:
+            self.jobs[job_id] = job
+        job.future = self.builds.submit(self._run, job)
+        return job
+
+    def cancel(self, job: ServiceJob) -> None:
+        if job.future is not None and job.future.cancel():
+            job.status = "cancelled"
+            job.finished = time.time()
+        elif job.handler is not None:
+            job.handler.cancel.cancel()
+
+    def close(self) -> None:
+        self._closed.set()
+        for job in self.list_jobs():
+            self.cancel(job)
+        self.builds.shutdown(wait=True)
+        if self.render_pool is not None:
+            self.render_pool.shutdown(wait=True)
+        save_session()
+
+    @staticmethod
+    def _validate(options: dict) -> dict:
+        if not isinstance(options, dict) or not (options.get("url") or options.get("slug")):
+            raise ValueError("Нужна ссылка на ранобэ: поле url или slug.")
+        if options.get("format", "epub") not in HANDLERS:
+            raise ValueError(f"Неизвестный формат, доступны: {', '.join(HANDLERS)}.")
+        if options.get("split_mode", "none") not in SPLIT_MODES:
+            raise ValueError(f"Неизвестный режим разбивки, доступны: {', '.join(SPLIT_MODES)}.")
+        for key, minimum in MINIMUMS.items():
+            value = options.get(key, minimum)
+            if not isinstance(value, int) or isinstance(value, bool):
+                raise ValueError(f"Поле {key} должно быть целым числом.")
+            if value < minimum:
+                raise ValueError(f"Поле {key} должно быть не меньше {minimum}.")
+        delay = options.get("delay")
+        if delay is not None and (not isinstance(delay, (int, float)) or isinstance(delay, bool) or not delay >= 0):
+            raise ValueError("Поле delay должно быть неотрицательным числом.")
+        return options
+
+    def _evict_loop(self) -> None:
+        while not self._closed.wait(EVICT_INTERVAL):
+            try:
+                self.evict()
+            except Exception:
+                logger.exception("Не удалось удалить старые задания")
+
+    def list_jobs(self) -> list[ServiceJob]:
+        with self._lock:
+            return list(self.jobs.values())
+
+    def evict(self) -> None:
+        """Удаляет просроченные и лишние завершённые задания с их файлами, а также давно не нужные картинки."""
+        now = time.time()
+        with self._lock:
+            finished = sorted((job for job in self.jobs.values() if job.finished is not None), key=lambda j: j.finished)
+            extra = max(0, len(finished) - config.service_keep_jobs)
+            expired = [
+                job for i, job in enumerate(finished) if i < extra or now - job.finished > config.service_job_ttl
+            ]
+            for job in expired:
+                del self.jobs[job.id]
+
+            with self._images_lock:
+                stale = [key for key, (used, _) in self._images.items() if now - used > config.service_job_ttl]
+                files = [self._images.pop(key)[1] for key in stale]
+            # Одинаковые картинки хранятся одним файлом, и он может быть нужен идущей сборке. Поэтому файлы удаляем,
+            # только когда сборок нет, и не отпуская блокировку, чтобы новая сборка не началась посреди удаления.
+            if not any(job.finished is None for job in self.jobs.values()):
+                for stored in files:
+                    try:
+                        os.remove(stored.path)
+                    except OSError:
+                        pass
+
+        for job in expired:
+            shutil.rmtree(job.dir, ignore_errors=True)
+
+        monotonic = time.monotonic()
+        with self._titles_lock:
+            for key, (loaded, _) in list(self._titles.items()):
+                if monotonic - loaded >= config.service_metadata_ttl:
+                    del self._titles[key]
+
+    def _title(self, slug: str, branch: str | None) -> tuple[dict, str, list[ChapterMeta]]:
+        """Данные ранобэ и список глав, не старше `config.service_metadata_ttl` секунд."""
+        key = (slug, branch)
+        with self._titles_lock:
+            cached = self._titles.get(key)
+        if cached is not None and time.monotonic() - cached[0] < config.service_metadata_ttl:
+            return cached[1]
+
+        title = load_title(slug, branch)
+        with self._titles_lock:
+            self._titles[key] = (time.monotonic(), title)
+        return title
+
+    def _image(self, url: str, extension: str, fetch: Callable[[], StoredFile]) -> StoredFile:
+        # Картинки остаются в `image_store` до конца работы сервиса, так что повторно их не качаем.
+        # Качество входит в ключ: профиль могут поменять между сборками.
+        key = f"{url}|{extension}|{config.image_quality}"
+        with self._images_lock:
+            cached = self._images.get(key)
+        if cached is not None and os.path.exists(cached[1].path):
+            with self._images_lock:
+                self._images[key] = (time.time(), cached[1])
+            return cached[1]
+
+        stored = fetch()
+        with self._images_lock:
+            self._images[key] = (time.time(), stored)
+        return stored
+
+    def _handler_class(self, format: str) -> type[Handler]:
+        service = self
+
+        class ServiceHandler(load_handler(format)):  # type: ignore
+            def _fetch_image(self, url: str, extension: str) -> StoredFile:
+                return service._image(url, extension, lambda: super(ServiceHandler, self)._fetch_image(url, extension))
+
+        return ServiceHandler
+
+    def _run(self, job: ServiceJob) -> None:
+        options = job.options
+        job.status = "running"
+        reload_profile()
+        try:
+            slug = slug_from_url(options.get("url") or options["slug"])
+            ranobe_data, priority_branch, chapters = self._title(slug, options.get("branch"))
+            chapters = select_chapters(chapters, options.get("start", 1), options.get("amount", 0))
+            if not chapters:
+                raise ValueError("Нет глав для скачивания.")
+            job.total = len(chapters)
+
+            handler = make_handler(
+                self._handler_class(options.get("format", "epub")),
+                str(job.dir),
+                log_func=job.log.append,
+                progress_bar_step=lambda step: setattr(job, "done", job.done + step),
+                with_images=options.get("with_images", True),
+                split_mode=options.get("split_mode", "none"),
+                split_value=options.get("split_value", 0),
+            )
+            handler.render_pool = self.render_pool
+            job.handler = handler
+            run_handler(handler, ranobe_data, slug, priority_branch, chapters, delay=options.get("delay"))
+            job.failed = list(handler.failed)
+            job.status = "cancelled" if handler.cancel.cancelled else "done"
+        except Exception as e:
+            logger.exception("Сборка %s завершилась ошибкой", job.id)
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished = time.time()
+            job.handler = None
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server: "ServiceServer"  # type: ignore
+
+    def log_message(self, format: str, *args) -> None:
+        logger.info(format, *args)
+
+    def _send_json(self, data: Any, status: int = 200) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status: int, message: str) -> None:
+        self._send_json({"error": message}, status)
+
+    def _job(self, job_id: str) -> ServiceJob | None:
+        job = self.server.service.jobs.get(job_id)
+        if job is None:
+            self._error(404, "Задание не найдено.")
+        return job
+
+    def do_GET(self) -> None:
+        parts = self.path.split("?")[0].strip("/").split("/")
+        service = self.server.service
+        match parts:
+            case ["jobs"]:
+                self._send_json([job.summary() for job in service.list_jobs()])
+            case ["jobs", job_id]:
+                if job := self._job(job_id):
+                    self._send_json(job.summary(lines=100))
+            case ["jobs", job_id, "files", name]:
+                if job := self._job(job_id):
+                    self._send_file(job, name)
+            case _:
+                self._error(404, "Нет такого адреса.")
+
+    def do_POST(self) -> None:
+        parts = self.path.split("?")[0].strip("/").split("/")
+        service = self.server.service
+        match parts:
+            case ["jobs"]:
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                    job = service.submit(json.loads(self.rfile.read(length) or b"{}"))
+                except ValueError as e:
+                    self._error(400, str(e))
+                    return
+                self._send_json(job.summary(), 201)
+            case ["jobs", job_id, "cancel"]:
+                if job := self._job(job_id):
+                    service.cancel(job)
+                    self._send_json(job.summary())
+            case _:
+                self._error(404, "Нет такого адреса.")
+
+    def _send_file(self, job: ServiceJob, name: str) -> None:
+        from urllib.parse import unquote
+
+        name = unquote(name)
+        if name not in job.files():
+            self._error(404, "Файл не найден.")
+            return
+
+        path = job.dir / name
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(path.stat().st_size))
+        self.end_headers()
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, self.wfile)
+
+
+class ServiceServer(ThreadingHTTPServer):
+    def __init__(self, address: tuple[str, int], service: BuildService) -> None:
+        super().__init__(address, RequestHandler)
+        self.service = service
+
+
+class UnixServiceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, service: BuildService) -> None:
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, RequestHandler)
+        self.service = service
+
+    def get_request(self):
+        # У Unix-сокета нет адреса клиента, а `BaseHTTPRequestHandler` ожидает пару (хост, порт).
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+def _interrupt(signum: int, frame: Any) -> None:
+    raise KeyboardInterrupt
+
+
+def serve(host: str = "", port: int = 0, unix_socket: str = "") -> None:
+    """Запускает сервис и работает до Ctrl+C или SIGTERM, затем останавливает сборки и сохраняет сессию."""
+    if not config.token:
+        config.token = restore_token()
+
+    service = BuildService()
+    if unix_socket:
+        server: socketserver.BaseServer = UnixServiceServer(unix_socket, service)
+        print(f"Сервис слушает {unix_socket}")
+    else:
+        server = ServiceServer((host or config.service_host, port or config.service_port), service)
+        print(f"Сервис слушает http://{server.server_address[0]}:{server.server_address[1]}")  # type: ignore
+
+    signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,158 @@
+import atexit
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from typing import TYPE_CHECKING
+
+import requests
+
+from src.config import config
+
+if TYPE_CHECKING:
+    import cloudscraper
+    from cryptography.fernet import Fernet
+
+
+def _fernet_class() -> type["Fernet"] | None:
+    try:
+        from cryptography.fernet import Fernet
+    except ImportError:
+        return None
+    return Fernet
+
+
+class SessionStore:
+    """Зашифрованный файл с токеном, cookies и User-Agent, под который Cloudflare выдал допуск.
+
+    Ключ лежит отдельным файлом рядом, доступным только владельцу. Без пакета `cryptography`
+    (`pip install .[secure]`) ничего не сохраняется: хранить токен открытым текстом не стоит.
+    """
+
+    def __init__(self, dir: str | None = None) -> None:
+        self._dir = dir
+
+    @property
+    def dir(self) -> Path:
+        return Path(self._dir or config.data_dir or Path.home() / ".ranobe2ebook")
+
+    @property
+    def path(self) -> Path:
+        return self.dir / "session.bin"
+
+    @property
+    def key_path(self) -> Path:
+        return self.dir / "session.key"
+
+    @property
+    def enabled(self) -> bool:
+        return _fernet_class() is not None
+
+    def _fernet(self) -> "Fernet":
+        Fernet = _fernet_class()
+        if not self.key_path.exists():
+            self.dir.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(Fernet.generate_key())
+        return Fernet(self.key_path.read_bytes())
+
+    def load(self) -> dict:
+        if not self.enabled or not self.path.exists():
+            return {}
+
+        from cryptography.fernet import InvalidToken
+
+        try:
+            return json.loads(self._fernet().decrypt(self.path.read_bytes()))
+        except (InvalidToken, ValueError, OSError):
+            # Файл повреждён или ключ сменился - начинаем с чистой сессии.
+            return {}
+
+    def save(self, state: dict) -> None:
+        if not self.enabled:
+            return
+
+        data = self._fernet().encrypt(json.dumps(state).encode("utf-8"))
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, self.path)
+
+
+def is_token_alive(token: str) -> bool:
+    from jwt import decode
+
+    try:
+        exp = decode(token, options={"verify_signature": False}).get("exp")
+    except Exception:
+        return False
+    return exp is None or exp > time.time()
+
+
+def _dump_cookies(jar: requests.cookies.RequestsCookieJar) -> list[dict]:
+    return [
+        {
+            "name": cookie.name,
+            "value": cookie.value,
+            "domain": cookie.domain,
+            "path": cookie.path,
+            "expires": cookie.expires,
+            "secure": cookie.secure,
+        }
+        for cookie in jar
+        if not cookie.is_expired()
+    ]
+
+
+def _load_cookies(jar: requests.cookies.RequestsCookieJar, cookies: list[dict]) -> None:
+    for cookie in cookies:
+        if cookie.get("expires") and cookie["expires"] <= time.time():
+            continue
+        jar.set_cookie(requests.cookies.create_cookie(**cookie))
+
+
+_store = SessionStore()
+_scraper: "cloudscraper.CloudScraper | None" = None
+_lock = threading.Lock()
+
+
+def get_scraper() -> "cloudscraper.CloudScraper":
+    """Общий для всей программы scraper. Cookies и допуск Cloudflare восстанавливаются с прошлого запуска."""
+    global _scraper
+    with _lock:
+        if _scraper is None:
+            import cloudscraper
+
+            scraper = cloudscraper.create_scraper()
+            state = _store.load()
+            if state.get("cookies"):
+                # Допуск Cloudflare привязан к User-Agent, с которым его получили.
+                if state.get("user_agent"):
+                    scraper.headers["User-Agent"] = state["user_agent"]
+                _load_cookies(scraper.cookies, state["cookies"])
+            _scraper = scraper
+            atexit.register(save_session)
+        return _scraper
+
+
+def restore_token() -> str:
+    """Возвращает сохранённый токен, если срок его действия ещё не истёк."""
+    token = _store.load().get("token", "")
+    return token if token and is_token_alive(token) else ""
+
+
+def save_session() -> None:
+    state = _store.load()
+    if config.token:
+        state["token"] = config.token
+    if _scraper is not None:
+        with _lock:
+            state["cookies"] = _dump_cookies(_scraper.cookies)
+            state["user_agent"] = _scraper.headers.get("User-Agent", "")
+    state["saved_at"] = time.time()
+    try:
+        _store.save(state)
+    except OSError:
+        pass
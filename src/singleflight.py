@@ -0,0 +1,40 @@
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable
+
+
+class SingleFlight:
+    """Объединяет одновременные одинаковые вызовы.
+
+    Первый вызов с ключом выполняется, остальные, пришедшие до его завершения, ждут и получают тот же
+    результат (или то же исключение). Результат не кешируется: следующий вызов после завершения выполнится заново.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, Future] = {}
+        self.shared = 0
+
+    def do(self, key: Hashable, func: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.shared += 1
+
+        if not leader:
+            return future.result()  # type: ignore
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)  # type: ignore
+            raise
+        else:
+            future.set_result(result)  # type: ignore
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
@@ -1,9 +1,17 @@
 import re
 import base64
+from typing import TYPE_CHECKING
 from urllib.parse import urlparse
 
-from jwt import decode, DecodeError
-from FB2 import Author
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+from src.model import ChapterMeta
+
+if TYPE_CHECKING:
+    from FB2 import Author
 
 
 def is_url(url) -> bool:
@@ -14,7 +22,9 @@ def is_url(url) -> bool:
         return False
 
 
-def set_authors(authors) -> list[Author]:
+def set_authors(authors) -> list["Author"]:
+    from FB2 import Author
+
     result_list = []
     for author in authors:
         result_list.append(
@@ -27,6 +37,9 @@ def set_authors(authors) -> list[Author]:
 
 
 def is_jwt(token) -> bool:
+    # jwt при импорте подтягивает cryptography, если она установлена, а токен нужен не при каждом запуске.
+    from jwt import decode, DecodeError
+
     parts = token.split(".")
     if len(parts) != 3:
         return False
@@ -95,6 +108,13 @@ def is_html(text) -> bool:
     return False
 
 
+IMG_SRC_PATTERN = re.compile(r"<img\b[^>]*?\ssrc=[\"']([^\"']+)[\"']", re.IGNORECASE)
+
+
+def find_img_sources(html: str) -> list[str]:
+    return IMG_SRC_PATTERN.findall(html)
+
+
 def is_valid_url(url) -> bool:
     parsed = urlparse(url)
 
@@ -103,3 +123,23 @@ def is_valid_url(url) -> bool:
         return bool(pattern.match(parsed.path))
 
     return False
+
+
+def plan_branches(chapters: list[ChapterMeta], priority_branch: str, branch_order: list[str]) -> dict[str, int]:
+    """Заранее решает, из какой ветки перевода будет скачана каждая глава.
+
+    Глава берётся из приоритетной ветки, если она там есть, иначе из первой доступной ветки
+    в порядке `branch_order` (как их отдаёт `get_branchs`). Для глав без информации о ветках
+    выбор остаётся за сервером. Возвращает количество глав по веткам.
+    """
+    plan: dict[str, int] = {}
+    for chapter in chapters:
+        if not chapter.branches or priority_branch in chapter.branches:
+            chapter.branch = priority_branch
+        else:
+            available = [branch for branch in branch_order if branch in chapter.branches]
+            chapter.branch = available[0] if available else chapter.branches[0]
+
+        plan[chapter.branch] = plan.get(chapter.branch, 0) + 1
+
+    return plan
@@ -0,0 +1,92 @@
+"""Фоновая подкачка новых глав отслеживаемых ранобэ в `disk_cache`.
+
+Подкачка проверяет список глав каждые `config.prefetch_interval` секунд. Работает она только в окно
+`config.prefetch_window` (например "01:00-07:00", пустая строка - в любое время), а между запросами
+к API выдерживает `config.prefetch_delay` секунд. После этого сборка с включённым кешем берёт главы
+и картинки с диска.
+"""
+
+import time
+from datetime import datetime
+from typing import Callable
+
+from src.api import get_chapter, get_image_content
+from src.cache import chapter_key, disk_cache, image_key
+from src.config import config
+from src.profile import reload_profile
+from src.runner import load_title
+
+
+def in_window(window: str, now: datetime | None = None) -> bool:
+    """Попадает ли время в окно вида "ЧЧ:ММ-ЧЧ:ММ". Окно может переходить через полночь."""
+    if not window:
+        return True
+
+    start, end = (datetime.strptime(part.strip(), "%H:%M").time() for part in window.split("-"))
+    current = (now or datetime.now()).time()
+    return start <= current < end if start <= end else current >= start or current < end
+
+
+def prefetch_title(slug: str, priority_branch: str | None, known: int = 0, log_func: Callable = print) -> int:
+    """Докачивает в кеш новые главы и их картинки. Возвращает число скачанных глав.
+
+    `known` - сколько глав уже подкачано при прошлых проверках (см. `disk_cache.watched`), их не проверяем.
+    Запоминается число глав до первой не скачанной, чтобы в следующий раз начать с неё.
+    """
+    _, priority_branch, chapters = load_title(slug, priority_branch)
+    known = min(known, len(chapters))
+    done, fetched, gap = known, 0, False
+    for chapter_meta in chapters[known:]:
+        if not in_window(config.prefetch_window):
+            log_func("Окно подкачки закончилось.")
+            break
+
+        branch = chapter_meta.branch if chapter_meta.branch is not None else priority_branch
+        key = chapter_key(slug, branch, chapter_meta)
+        if disk_cache.has(key):
+            done += not gap
+            continue
+
+        time.sleep(config.prefetch_delay)
+        try:
+            chapter = get_chapter(slug, branch, chapter_meta.number, chapter_meta.volume)
+        except Exception as e:
+            log_func(f"Ошибка: {e}")
+            gap = True
+            continue
+
+        for _, url, _, extension in chapter.image_sources:
+            if disk_cache.has(image_key(url, extension)):
+                continue
+            try:
+                disk_cache.put(image_key(url, extension), get_image_content(url, extension).read())
+            except Exception as e:
+                log_func(f"Ошибка: {e}")
+
+        # Главу кладём после картинок: если подкачку прервут, глава с недостающими картинками скачается заново.
+        disk_cache.put(key, chapter.raw)
+        fetched += 1
+        done += not gap
+        log_func(f"{slug}: Том {chapter_meta.volume}. Глава {chapter_meta.number}. {chapter_meta.name}")
+
+    disk_cache.checked(slug, done)
+    return fetched
+
+
+def run_prefetcher(once: bool = False, log_func: Callable = print) -> None:
+    """Проверяет все отслеживаемые ранобэ, с `once` - один раз, иначе бесконечно."""
+    while True:
+        reload_profile()
+        if in_window(config.prefetch_window):
+            for slug, branch, known, _ in disk_cache.watched():
+                try:
+                    fetched = prefetch_title(slug, branch, known, log_func)
+                except Exception as e:
+                    log_func(f"{slug}: {e}")
+                    continue
+                if fetched:
+                    log_func(f"{slug}: новых глав в кеше - {fetched}")
+
+        if once:
+            return
+        time.sleep(config.prefetch_interval if in_window(config.prefetch_window) else 60)
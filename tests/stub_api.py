@@ -0,0 +1,170 @@
+"""Заглушка API ranobelib для проверок без сети.
+
+    python -m tests.stub_api --port 8765 --chapters 30
+
+После запуска в профиле (см. `src.profile`) достаточно указать:
+
+    api_url = "http://127.0.0.1:8765/api"
+    site_url = "http://127.0.0.1:8765"
+
+Ранобэ у заглушки одно, slug любой. В каждой главе есть абзацы и картинка; картинок всего пять,
+так что одна и та же картинка встречается в разных главах.
+"""
+
+import argparse
+import io
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image as PILImage
+
+BRANCH_ID = 7
+IMAGES = 5
+
+
+def _png(seed: int) -> bytes:
+    buffer = io.BytesIO()
+    PILImage.new("RGB", (16, 16), (seed * 40 % 256, 80, 160)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class StubAPI:
+    """Заглушка в фоновом потоке. `port=0` - свободный порт. `requests` считает запросы по виду."""
+
+    def __init__(self, chapters: int = 30, per_volume: int = 10, delay: float = 0.0, port: int = 0) -> None:
+        self.chapters = chapters
+        self.per_volume = per_volume
+        self.delay = delay
+        self.requests: Counter[str] = Counter()
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self.thread: threading.Thread | None = None
+
+    @property
+    def site_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    @property
+    def api_url(self) -> str:
+        return f"{self.site_url}/api"
+
+    def start(self) -> "StubAPI":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, kind: str) -> None:
+        with self._lock:
+            self.requests[kind] += 1
+
+    def ranobe(self) -> dict:
+        return {
+            "id": 1,
+            "name": "Stub",
+            "rus_name": "Заглушка",
+            "summary": "Ранобэ для проверок.",
+            "authors": [{"name": "Автор"}],
+            "genres": [{"name": "Фэнтези"}],
+            "franchise": [],
+            "cover": {"default": f"{self.site_url}/img/cover.png"},
+        }
+
+    def chapter_list(self) -> list[dict]:
+        return [
+            {
+                "name": f"Глава {i}",
+                "number": str(i),
+                "volume": str((i - 1) // self.per_volume + 1),
+                "branches": [{"branch_id": BRANCH_ID}],
+            }
+            for i in range(1, self.chapters + 1)
+        ]
+
+    def chapter(self, number: str, volume: str) -> dict:
+        paragraphs = [
+            {"type": "paragraph", "content": [{"type": "text", "text": f"Глава {number}, абзац {i}."}]}
+            for i in range(10)
+        ]
+        image = {"type": "image", "attrs": {"images": [{"image": "picture"}]}}
+        attachment = {
+            "id": "1",
+            "name": "picture",
+            "filename": f"{number}.png",
+            "extension": "png",
+            "url": f"/img/{int(number) % IMAGES}.png",
+        }
+        return {
+            "id": number,
+            "number": number,
+            "volume": volume,
+            "content": {"type": "doc", "content": [*paragraphs, image]},
+            "attachments": [attachment],
+        }
+
+    def _handler_class(self) -> type[BaseHTTPRequestHandler]:
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+            def _send(self, body: bytes, content_type: str = "application/json") -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _json(self, data) -> None:
+                self._send(json.dumps({"data": data}).encode())
+
+            def do_GET(self) -> None:
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path.startswith("/api/branches/"):
+                    stub.count("branches")
+                    return self._json([{"id": BRANCH_ID}])
+                if url.path.startswith("/api/manga/") and url.path.endswith("/chapters"):
+                    stub.count("chapters")
+                    return self._json(stub.chapter_list())
+                if url.path.startswith("/api/manga/") and url.path.endswith("/chapter"):
+                    stub.count("chapter")
+                    time.sleep(stub.delay)
+                    return self._json(stub.chapter(query["number"][0], query["volume"][0]))
+                if url.path.startswith("/api/manga/"):
+                    stub.count("ranobe")
+                    return self._json(stub.ranobe())
+                if url.path.startswith("/img/"):
+                    stub.count("image")
+                    return self._send(_png(sum(url.path.encode())), "image/png")
+                self.send_response(404)
+                self.end_headers()
+
+        return Handler
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--chapters", type=int, default=30)
+    parser.add_argument("--delay", type=float, default=0.0, help="задержка ответа на запрос главы, секунд")
+    args = parser.parse_args()
+
+    stub = StubAPI(chapters=args.chapters, delay=args.delay, port=args.port)
+    print(f"api_url = {stub.api_url!r}\nsite_url = {stub.site_url!r}")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Распределённое скачивание целиком: два процесса `jobs work` и `jobs assemble` против заглушки API.
+
+Запуск из корня репозитория: `python -m unittest tests.test_jobs`.
+"""
+
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+import zipfile
+
+from src.jobs import JobStore
+from src.model import ChapterMeta
+from tests.stub_api import StubAPI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class DistributedJobTest(unittest.TestCase):
+    chapters = 12
+
+    def setUp(self) -> None:
+        # Небольшая задержка ответа, чтобы второй рабочий успел забрать свою долю блоков.
+        self.stub = StubAPI(chapters=self.chapters, per_volume=5, delay=0.05).start()
+        self.addCleanup(self.stub.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.db = os.path.join(self.dir, "jobs.sqlite")
+        self.profile = os.path.join(self.dir, "profile.toml")
+        with open(self.profile, "w", encoding="utf-8") as f:
+            f.write(
+                f'api_url = "{self.stub.api_url}"\n'
+                f'site_url = "{self.stub.site_url}"\n'
+                f'data_dir = "{self.dir}"\n'
+                "job_unit_size = 2\n"
+                "request_delay = 0\n"
+                "retries = 0\n"
+                "render_workers = 1\n"
+            )
+
+    def _jobs(self, *args: str) -> subprocess.Popen:
+        return subprocess.Popen(
+            [sys.executable, "-m", "src.cli", "--profile", self.profile, "jobs", *args, "--db", self.db],
+            cwd=ROOT,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+
+    def _run(self, *args: str) -> str:
+        process = self._jobs(*args)
+        output, _ = process.communicate(timeout=120)
+        self.assertEqual(process.returncode, 0, output)
+        return output
+
+    def test_two_workers_then_assemble(self) -> None:
+        self._run("create", "stub-title")
+
+        workers = [self._jobs("work", "--worker", name) for name in ("w1", "w2")]
+        for worker in workers:
+            output, _ = worker.communicate(timeout=120)
+            self.assertEqual(worker.returncode, 0, output)
+
+        with sqlite3.connect(self.db) as db:
+            statuses = dict(db.execute("SELECT status, COUNT(*) FROM units GROUP BY status").fetchall())
+            claimed_by = {worker for (worker,) in db.execute("SELECT DISTINCT worker FROM units")}
+        self.assertEqual(statuses, {"done": self.chapters // 2})
+        self.assertLessEqual(claimed_by, {"w1", "w2"})
+        # Каждую главу скачал ровно один рабочий.
+        self.assertEqual(self.stub.requests["chapter"], self.chapters)
+
+        out = os.path.join(self.dir, "books")
+        self._run("assemble", "1", "--format", "epub", "--out", out)
+        self.assertEqual(self.stub.requests["chapter"], self.chapters, "сборка не должна ходить в API за главами")
+
+        books = os.listdir(out)
+        self.assertEqual(len(books), 1)
+        with zipfile.ZipFile(os.path.join(out, books[0])) as book:
+            documents = [name for name in book.namelist() if re.search(r"/\d+_\d+\.xhtml$", name)]
+            images = [name for name in book.namelist() if name.endswith(".png")]
+        self.assertEqual(len(documents), self.chapters)
+        self.assertTrue(images)
+
+    def test_lost_lease_is_not_written(self) -> None:
+        store = JobStore(self.db)
+        job_id = store.create_job("stub-title", "", {}, [ChapterMeta(name="", number=1, volume=1)], unit_size=1)
+        self.assertEqual(store.claim("w1", job_id), (job_id, 0))
+        self.assertTrue(store.renew(job_id, 0, "w1"))
+
+        # Аренда w1 истекла, и блок забрал w2.
+        with sqlite3.connect(self.db) as db:
+            db.execute("UPDATE units SET claimed_at = 0")
+        self.assertEqual(store.claim("w2", job_id), (job_id, 0))
+
+        self.assertFalse(store.renew(job_id, 0, "w1"))
+        self.assertFalse(store.finish_unit(job_id, 0, "w1", [(0, b"w1", None)], []))
+        self.assertTrue(store.finish_unit(job_id, 0, "w2", [(0, b"w2", None)], []))
+        self.assertEqual(store.chapter(job_id, ChapterMeta(name="", number=1, volume=1)).raw, b"w2")
+        self.assertEqual(store.progress(job_id), {"done": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()